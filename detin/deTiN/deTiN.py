@@ -1,21 +1,24 @@
 import argparse
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from itertools import compress
-import copy
 
 import deTiN_utilities as du
 import deTiN_SSNV_based_estimate as dssnv
 import deTiN_aSCNA_based_estimate as dascna
+import deTiN_parallel as dpar
 import numpy.ma as ma
 
 class input:
     """class which holds the required detin somatic data prior to model"""
 
     def __init__(self, args, ascna_probe_number_filter=200, ascna_SNP_number_filter=20, coverage_threshold=15,
-                 SSNV_af_threshold=0.15, aSCNA_variance_threshold=0.025):
+                 SSNV_af_threshold=0.15, aSCNA_variance_threshold=0.025, max_memory=2, coarse_resolution=0,
+                 precision='float64', threads=1, executor='thread', genome_build='GRCh38', reference_index='None',
+                 centromere_telomere_distance=5000000, seed=1, het_coverage_threshold=0, plots='all',
+                 cache_dir='None'):
 
         # related to inputs from command line
         self.call_stats_file = args.mutation_data_path
@@ -86,6 +89,77 @@ class input:
         except AttributeError:
             self.aSCNA_variance_threshold = 'NA'
 
+        try:
+            self.max_memory = float(args.max_memory)
+        except AttributeError:
+            self.max_memory = max_memory
+
+        try:
+            self.coarse_resolution = int(args.coarse_resolution)
+        except AttributeError:
+            self.coarse_resolution = coarse_resolution
+
+        try:
+            self.precision = args.precision
+        except AttributeError:
+            self.precision = precision
+
+        try:
+            self.precision_report = args.precision_report
+        except AttributeError:
+            self.precision_report = False
+
+        try:
+            self.threads = int(args.threads)
+        except AttributeError:
+            self.threads = threads
+
+        # one worker pool shared by all the models of the run
+        try:
+            self.executor = dpar.executor(args.executor, self.threads)
+        except AttributeError:
+            self.executor = dpar.as_executor(executor, self.threads)
+
+        try:
+            self.genome_build = args.genome_build
+        except AttributeError:
+            self.genome_build = genome_build
+
+        try:
+            self.reference_index = args.reference_index
+        except AttributeError:
+            self.reference_index = reference_index
+        # chromosome codes and linear coordinates of the reference
+        self.genome = du.genome_index(self.genome_build, self.reference_index)
+
+        try:
+            self.centromere_telomere_distance = float(args.centromere_telomere_distance)
+        except AttributeError:
+            self.centromere_telomere_distance = centromere_telomere_distance
+
+        try:
+            self.seed = int(args.seed)
+        except AttributeError:
+            self.seed = seed
+
+        try:
+            self.het_coverage_threshold = float(args.het_coverage_threshold)
+        except AttributeError:
+            self.het_coverage_threshold = het_coverage_threshold
+
+        try:
+            self.plots = args.plots
+        except AttributeError:
+            self.plots = plots
+
+        # directory of the hot spot and converted ExAC pickle caches, the output directory by default
+        try:
+            self.cache_dir = args.cache_dir
+        except AttributeError:
+            self.cache_dir = cache_dir
+        if self.cache_dir == 'None':
+            self.cache_dir = self.output_path
+
         # related to inputs from class functions
         self.call_stats_table = []
         self.seg_table = []
@@ -98,58 +172,28 @@ class input:
         fields = ['contig', 'position', 'ref_allele', 'alt_allele', 'tumor_name', 'normal_name', 't_alt_count',
                   't_ref_count'
             , 'n_alt_count', 'n_ref_count', 'failure_reasons', 'judgement','t_lod_fstar']
-        fields_type = {'contig': str, 'position': np.int, 'ref_allele': str, 'alt_allele': str, 'tumor_name': str,
+        fields_type = {'contig': str, 'position': np.int64, 'ref_allele': str, 'alt_allele': str, 'tumor_name': str,
                        'normal_name': str,
-                       't_alt_count': np.int, 't_ref_count': np.int, 'n_alt_count': np.int, 'n_ref_count': np.int,
+                       't_alt_count': np.int64, 't_ref_count': np.int64, 'n_alt_count': np.int64,
+                       'n_ref_count': np.int64,
                        'failure_reasons': str, 'judgement': str}
-        try:
-            self.call_stats_table = pd.read_csv(self.call_stats_file, '\t', index_col=False,
-                                                comment='#', usecols=fields, dtype=fields_type)
-        except (ValueError, LookupError):
-            try:
-                fields = ['contig', 'position', 'ref_allele', 'alt_allele', 'tumor_name', 'normal_name', 't_alt_count',
-                          't_ref_count'
-                    , 'n_alt_count', 'n_ref_count', 'failure_reasons', 'judgement']
-                self.call_stats_table = pd.read_csv(self.call_stats_file, '\t', index_col=False,
-                                                comment='#', usecols=fields, dtype=fields_type)
-            except (ValueError, LookupError):
-                print('Error reading call stats skipping first two rows and trying again')
-                self.call_stats_table   = pd.read_csv(self.call_stats_file, '\t', index_col=False,
-                                                comment='#', skiprows=2, usecols=fields, dtype=fields_type)
-        if type(self.call_stats_table['contig'][0]) == str:
-            self.call_stats_table['Chromosome'] = du.chr2num(np.array(self.call_stats_table['contig']))
-        else:
-            self.call_stats_table['Chromosome'] = np.array(self.call_stats_table['contig']) - 1
+        # only the candidate mutations are kept while parsing, t_lod_fstar is read when present
+        self.call_stats_table, n_sites = du.read_call_stats_candidates(self.call_stats_file, fields[:-1], fields_type,
+                                                                       optional_fields=fields[-1:])
+        print('kept ' + str(len(self.call_stats_table)) + ' candidate mutations of ' + str(n_sites) + ' call stats sites')
+        self.call_stats_table['Chromosome'] = du.chr2num(np.array(self.call_stats_table['contig']), self.genome)
         self.call_stats_table = self.call_stats_table[np.isfinite(self.call_stats_table['Chromosome'])]
-        self.call_stats_table['genomic_coord_x'] = du.hg19_to_linear_positions(
+        self.call_stats_table['genomic_coord_x'] = self.genome.linear_positions(
             np.array(self.call_stats_table['Chromosome']), np.array(self.call_stats_table['position']))
-        self.n_calls_in = len(self.call_stats_table)
         self.call_stats_table.reset_index(inplace=True, drop=True)
 
     def read_het_file(self):
-        t_het_header = du.read_file_header(self.tumor_het_file)
-        n_het_header = du.read_file_header(self.normal_het_file)
-        cols_t_type = {t_het_header[0]: str}
-        cols_n_type = {n_het_header[0]: str}
-        tumor_het_table = pd.read_csv(self.tumor_het_file, '\t', index_col=False, low_memory=False, comment='#',
-                                      dtype=cols_t_type)
-        normal_het_table = pd.read_csv(self.normal_het_file, '\t', index_col=False, low_memory=False, comment='#',
-                                       dtype=cols_n_type)
-        tumor_het_table = du.fix_het_file_header(tumor_het_table)
-        normal_het_table = du.fix_het_file_header(normal_het_table)
-        tumor_het_table['Chromosome'] = du.chr2num(np.array(tumor_het_table['CONTIG']))
-        normal_het_table['Chromosome'] = du.chr2num(np.array(normal_het_table['CONTIG']))
-        tumor_het_table = tumor_het_table[np.isfinite(tumor_het_table['Chromosome'])]
-        tumor_het_table['genomic_coord_x'] = du.hg19_to_linear_positions(np.array(tumor_het_table['Chromosome']),
-                                                                         np.array(tumor_het_table['POSITION']))
-        normal_het_table = normal_het_table[np.isfinite(normal_het_table['Chromosome'])]
-        normal_het_table['genomic_coord_x'] = du.hg19_to_linear_positions(np.array(normal_het_table['Chromosome']),
-                                                                          np.array(normal_het_table['POSITION']))
-        tumor_het_table['AF'] = np.true_divide(tumor_het_table['ALT_COUNT'],
-                                               tumor_het_table['ALT_COUNT'] + tumor_het_table['REF_COUNT'])
-        normal_het_table['AF'] = np.true_divide(normal_het_table['ALT_COUNT'],
-                                                normal_het_table['ALT_COUNT'] + normal_het_table['REF_COUNT'])
-        self.het_table = pd.merge(normal_het_table, tumor_het_table, on='genomic_coord_x', suffixes=('_N', '_T'))
+        # hets near centromeres and telomeres or below the coverage threshold are dropped while reading
+        tumor_het_table = du.read_het_file_filtered(self.tumor_het_file, self.genome, self.centromere_telomere_distance,
+                                                    self.het_coverage_threshold)
+        normal_het_table = du.read_het_file_filtered(self.normal_het_file, self.genome,
+                                                     self.centromere_telomere_distance, self.het_coverage_threshold)
+        self.het_table = du.sort_merge_hets(normal_het_table, tumor_het_table)
 
     def read_seg_file(self):
         if self.seg_file == 'NULL':
@@ -162,39 +206,25 @@ class input:
             self.seg_table = pd.read_csv(self.seg_file, '\t', index_col=False, low_memory=False, comment='#',
                                      dtype=cols_seg_type)
             self.seg_table = du.fix_seg_file_header(self.seg_table)
-            self.seg_table['Chromosome'] = du.chr2num(np.array(self.seg_table['Chromosome']))
+            self.seg_table['Chromosome'] = du.chr2num(np.array(self.seg_table['Chromosome']), self.genome)
 
-            self.seg_table['genomic_coord_start'] = du.hg19_to_linear_positions(np.array(self.seg_table['Chromosome']),
-                                                                            np.array(self.seg_table['Start.bp']))
-            self.seg_table['genomic_coord_end'] = du.hg19_to_linear_positions(np.array(self.seg_table['Chromosome']),
-                                                                          np.array(self.seg_table['End.bp']))
+            self.seg_table['genomic_coord_start'] = self.genome.linear_positions(np.array(self.seg_table['Chromosome']),
+                                                                             np.array(self.seg_table['Start.bp']))
+            self.seg_table['genomic_coord_end'] = self.genome.linear_positions(np.array(self.seg_table['Chromosome']),
+                                                                           np.array(self.seg_table['End.bp']))
 
     def annotate_call_stats_with_allelic_cn_data(self):
-        f_acs = np.zeros([self.n_calls_in, 1]) + 0.5
-        tau = np.zeros([self.n_calls_in, 1]) + 2
-        for i, r in self.seg_table.iterrows():
-            f_acs[np.logical_and(np.array(self.call_stats_table['genomic_coord_x']) >= r['genomic_coord_start'],
-                                 np.array(self.call_stats_table['genomic_coord_x']) <= r['genomic_coord_end'])] = r.f
-            tau[np.logical_and(np.array(self.call_stats_table['genomic_coord_x']) >= r['genomic_coord_start'],
-                               np.array(self.call_stats_table['genomic_coord_x']) <= r[
-                                   'genomic_coord_end'])] = r.tau + 0.001
-        self.call_stats_table['tau'] = tau
-        self.call_stats_table['f_acs'] = f_acs
+        segments = du.segment_index(self.seg_table)
+        seg_rows = segments.lookup(self.call_stats_table['genomic_coord_x'])
+        self.call_stats_table['tau'] = np.where(seg_rows >= 0, segments.values(seg_rows, 'tau', 2) + 0.001, 2)
+        self.call_stats_table['f_acs'] = segments.values(seg_rows, 'f', 0.5)
 
     def annotate_het_table(self):
-        seg_id = np.zeros([len(self.het_table), 1]) - 1
-        tau = np.zeros([len(self.het_table), 1]) + 2
-        f = np.zeros([len(self.het_table), 1]) + 0.5
-        for seg_index, seg in self.seg_table.iterrows():
-            het_index = np.logical_and(self.het_table['genomic_coord_x'] >= seg['genomic_coord_start'],
-                                       self.het_table['genomic_coord_x'] <= seg['genomic_coord_end'])
-            ix = list(compress(range(len(het_index)), het_index))
-            seg_id[ix] = seg_index
-            tau[ix] = seg['tau']
-            f[ix] = seg['f']
-        self.het_table['seg_id'] = seg_id
-        self.het_table['tau'] = tau
-        self.het_table['f'] = f
+        segments = du.segment_index(self.seg_table)
+        seg_rows = segments.lookup(self.het_table['genomic_coord_x'])
+        self.het_table['seg_id'] = segments.labels(seg_rows)
+        self.het_table['tau'] = segments.values(seg_rows, 'tau', 2)
+        self.het_table['f'] = segments.values(seg_rows, 'f', 0.5)
         d = np.ones([len(self.het_table), 1])
         d[np.array(self.het_table['AF_T'] <= 0.5, dtype=bool)] = -1
         self.skew = 0.5
@@ -205,7 +235,7 @@ class input:
         self.annotate_call_stats_with_allelic_cn_data()
         if not self.indel_file == 'None':
             if not self.indel_type == 'None':
-                self.indel_table = du.read_indel_vcf(self.indel_file, self.seg_table, self.indel_type)
+                self.indel_table = du.read_indel_vcf(self.indel_file, self.seg_table, self.indel_type, self.genome)
             else:
                 print('Warning: if indels are provided you must also specify indel data source using --indel_data_type')
                 print('no indels will be returned')
@@ -217,7 +247,6 @@ class input:
         self.seg_table = du.filter_segments_based_on_size_f_and_tau(self.seg_table, self.aSCNA_thresh,
                                                                     self.ascna_probe_number_filter)
         self.annotate_het_table()
-        self.het_table = du.remove_sites_near_centromere_and_telomeres(self.het_table)
 
     def read_and_preprocess_data(self):
         self.read_and_preprocess_SSNVs()
@@ -271,71 +300,25 @@ class output:
                 print('reselected cluster based on SSNVs')
             # combine independent likelihoods
             self.joint_log_likelihood = self.ascna_based_model.TiN_likelihood + self.ssnv_based_model.TiN_likelihood
-            # normalize likelihood to calculate posterior
-            self.joint_posterior = np.exp(self.ascna_based_model.TiN_likelihood + self.ssnv_based_model.TiN_likelihood
-                                          - np.nanmax(
-                self.ascna_based_model.TiN_likelihood + self.ssnv_based_model.TiN_likelihood))
-            self.joint_posterior = np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))
-            self.CI_tin_low = self.TiN_range[next(x[0] for x in enumerate(
-                np.cumsum(np.ma.masked_array(np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))))) if
-                                                  x[1] > 0.025)]
-            self.CI_tin_high = self.TiN_range[
-                next(x[0] for x in enumerate(np.cumsum(
-                    np.ma.masked_array(np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))))) if
-                     x[1] > 0.975)]
-
-            self.TiN_int = np.nanargmax(self.joint_posterior)
-            self.TiN = self.TiN_range[self.TiN_int]
-
-            zero_tin_ssnv_model = copy.deepcopy(self.ssnv_based_model)
-            zero_tin_ssnv_model.TiN = 0
-            zero_tin_ssnv_model.expectation_of_z_given_TiN()
-            zero_tin_ssnv_model.maximize_TiN_likelihood()
-            zero_total_l = zero_tin_ssnv_model.TiN_likelihood + self.ascna_based_model.TiN_likelihood
-            zero_total_l = np.exp(zero_total_l - np.nanmax(zero_total_l))
-            self.p_null = np.true_divide(zero_total_l,np.nansum(zero_total_l))[0]
+            self.summarize_joint_likelihood()
+
+            zero_total_l = self.ssnv_based_model.fixed_TiN_likelihood(0) + self.ascna_based_model.TiN_likelihood
+            self.p_null = du.tin_posterior_summary(zero_total_l)[0][0, 0]
             print('joint TiN estimate = ' + str(self.TiN))
         # use only ssnv based model
         elif ~np.isnan(self.ascna_based_model.TiN):
             # otherwise TiN estimate is = to aSCNA estimate
             print('SSNV based TiN estimate exceed 0.3 using only aSCNA based estimate')
             self.joint_log_likelihood = self.ascna_based_model.TiN_likelihood
-            self.joint_posterior = np.exp(
-                self.ascna_based_model.TiN_likelihood - np.nanmax(self.ascna_based_model.TiN_likelihood))
-            self.joint_posterior = np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))
-            self.CI_tin_low = self.TiN_range[next(x[0] for x in enumerate(
-                np.cumsum(np.ma.masked_array(np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))))) if
-                                                  x[1] > 0.025)]
-            self.CI_tin_high = self.TiN_range[
-                next(x[0] for x in enumerate(np.cumsum(
-                    np.ma.masked_array(np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))))) if
-                     x[1] > 0.975)]
-            self.TiN_int = np.nanargmax(self.joint_posterior)
-            self.TiN = self.TiN_range[self.TiN_int]
+            self.summarize_joint_likelihood()
             self.p_null = self.joint_posterior[0]
         # use only aSCNA based estimate
         elif ~np.isnan(self.ssnv_based_model.TiN) and self.ssnv_based_model.TiN <= 0.3:
             print('No aSCNAs only using SSNV based model')
             self.joint_log_likelihood = self.ssnv_based_model.TiN_likelihood
-            self.joint_posterior = np.exp(
-                self.ssnv_based_model.TiN_likelihood - np.nanmax(self.ssnv_based_model.TiN_likelihood))
-            self.joint_posterior = np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))
-            self.CI_tin_low = self.TiN_range[next(x[0] for x in enumerate(
-                np.cumsum(np.ma.masked_array(np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))))) if
-                                                  x[1] > 0.025)]
-            self.CI_tin_high = self.TiN_range[
-                next(x[0] for x in enumerate(np.cumsum(
-                    np.ma.masked_array(np.true_divide(self.joint_posterior, np.nansum(self.joint_posterior))))) if
-                     x[1] > 0.975)]
-            self.TiN_int = np.nanargmax(self.joint_posterior)
-            self.TiN = self.TiN_range[self.TiN_int]
-            zero_tin_ssnv_model = copy.deepcopy(self.ssnv_based_model)
-            zero_tin_ssnv_model.TiN = 0
-            zero_tin_ssnv_model.expectation_of_z_given_TiN()
-            zero_tin_ssnv_model.maximize_TiN_likelihood()
-            zero_total_l = zero_tin_ssnv_model.TiN_likelihood
-            zero_total_l = np.exp(zero_total_l - np.nanmax(zero_total_l))
-            self.p_null = np.true_divide(zero_total_l, np.nansum(zero_total_l))[0]
+            self.summarize_joint_likelihood()
+            zero_total_l = self.ssnv_based_model.fixed_TiN_likelihood(0)
+            self.p_null = du.tin_posterior_summary(zero_total_l)[0][0, 0]
         else:
             print('insuffcient data to generate TiN estimate.')
             self.CI_tin_high = 0
@@ -364,29 +347,24 @@ class output:
             self.CI_tin_high = 0
             self.CI_tin_low = 0
 
+    def summarize_joint_likelihood(self):
+        # posterior, MAP and 95% CI of the joint log likelihood
+        posterior, tin_map, ci_low, ci_high = du.tin_posterior_summary(self.joint_log_likelihood)
+        self.joint_posterior = posterior[0]
+        self.CI_tin_low = self.TiN_range[ci_low[0]]
+        self.CI_tin_high = self.TiN_range[ci_high[0]]
+        self.TiN_int = tin_map[0]
+        self.TiN = self.TiN_range[self.TiN_int]
+
     def reclassify_mutations(self):
         # calculate p(Somatic | given joint TiN estimate)
+        # weighted classification integrates over the TiN bins with posterior > 0.001
         if self.input.weighted_classification == True:
-            numerator = np.zeros(len(self.ssnv_based_model.p_TiN_given_S))
-            denominator = np.zeros(len(self.ssnv_based_model.p_TiN_given_S))
-            for idx, p in enumerate(self.joint_posterior):
-                if p > 0.001:
-                    num_iter = (p * self.ssnv_based_model.p_somatic * self.ssnv_based_model.p_TiN_given_S[:, idx])
-                    numerator = numerator + num_iter
-                    denom_iter = num_iter + p * (np.array(
-                        [1 - self.ssnv_based_model.p_somatic] * np.nan_to_num(
-                            self.ssnv_based_model.p_TiN_given_G[:, idx])))
-                    denominator = denominator + denom_iter
-
+            tin_weights = np.ravel(self.joint_posterior)
         else:
-            numerator = self.ssnv_based_model.p_somatic * np.expand_dims(
-                self.ssnv_based_model.p_TiN_given_S[:, self.TiN_int], 1)
-            denominator = numerator + np.array(
-                [1 - self.ssnv_based_model.p_somatic] * np.expand_dims(
-                    np.nan_to_num(self.ssnv_based_model.p_TiN_given_G[:, self.TiN_int]), 1))
-        # print(">>>>")
-        self.SSNVs = self.SSNVs.assign(p_somatic_given_TiN=np.nan_to_num(np.true_divide(numerator, denominator))[0])
-        # self.SSNVs.loc[:, ('p_somatic_given_TiN')] = np.nan_to_num(np.true_divide(numerator, denominator))
+            tin_weights = np.zeros(self.input.resolution)
+            tin_weights[self.TiN_int] = 1
+        self.SSNVs = self.SSNVs.assign(p_somatic_given_TiN=self.ssnv_based_model.p_somatic_given_TiN_weights(tin_weights))
         # expected normal allele fraction given TiN and tau
         af_n_given_TiN = np.multiply(self.ssnv_based_model.tumor_f, self.ssnv_based_model.CN_ratio[:, self.TiN_int])
         # probability of normal allele fraction less than or equal to predicted fraction
@@ -401,17 +379,14 @@ class output:
             self.SSNVs['judgement'][self.SSNVs['p_somatic_given_TiN'] > self.threshold] = 'KEEP'
         if self.input.indel_file != 'None':
             if self.input.indel_table.isnull().values.sum() == 0:
-                indel_model = dssnv.model(self.input.indel_table, self.input.mutation_prior, self.input.resolution)
-                indel_model.generate_conditional_ps()
+                indel_model = dssnv.model(self.input.indel_table, self.input.mutation_prior, self.input.resolution,
+                                          max_memory=self.input.max_memory, precision=self.input.precision,
+                                          threads=self.input.threads, executor=self.input.executor,
+                                          genome=self.input.genome)
+                # only the TiN columns with weight in the classification are computed for indels
                 self.indels = self.input.indel_table
-                numerator = indel_model.p_somatic * np.expand_dims(indel_model.p_TiN_given_S[:, self.TiN_int], 1)
-                denominator = numerator + np.array(
-                    [1 - indel_model.p_somatic] * np.expand_dims(np.nan_to_num(
-                        indel_model.p_TiN_given_G[:, self.TiN_int]), 1))
                 af_n_given_TiN = np.multiply(indel_model.tumor_f, indel_model.CN_ratio[:, self.TiN_int])
-                self.indels = self.indels.assign(
-                    p_somatic_given_TiN=np.nan_to_num(np.nan_to_num(np.true_divide(numerator, denominator))[0]))
-                # self.indels.loc[:, ('p_somatic_given_TiN')] = np.nan_to_num(np.true_divide(numerator, denominator))
+                self.indels = self.indels.assign(p_somatic_given_TiN=indel_model.p_somatic_given_TiN_weights(tin_weights))
                 self.indels = self.indels.assign(p_outlier=indel_model.rv_normal_af.cdf(af_n_given_TiN))
                 # self.indels.loc[:, 'p_outlier'] = indel_model.rv_normal_af.cdf(af_n_given_TiN)
                 if self.TiN_int == 0:
@@ -452,7 +427,9 @@ def main():
                              'Required columns: CONTIG,POS,REF_COUNT and ALT_COUNT', required=False,
                         default = 'NULL')
     parser.add_argument('--exac_data_path',
-                        help='Path to exac af > 0.01 pickle. Can be generated by downloading ExAC VCF and running build_exac_pickle',
+                        help='Path to germline site index (.npy) of population af > 0.01 sites. Can be generated from the '
+                             'ExAC or gnomAD VCF with build_germline_site_index. Legacy ExAC pickles are also read '
+                             'and converted once to a .npy index in --cache_dir',
                         required=False)
     parser.add_argument('--indel_data_path',
                         help='Path to candidate indels data.'
@@ -501,6 +478,54 @@ def main():
                         , required=False, default='NA')
     parser.add_argument('--only_ascnas',
                         help='only use ascna data for TiN estimation',required=False, action='store_true')
+    parser.add_argument('--max_memory',
+                        help='memory budget in GB for the temporary arrays of the TiN likelihood kernels, '
+                             'larger values evaluate more TiN values per call. The input tables, models and worker '
+                             'processes come on top of it, so keep it well below the memory of the job (the Nextflow '
+                             'module passes half of params.mem)', required=False, default=2)
+    parser.add_argument('--coarse_resolution',
+                        help='number of TiN bins of the first pass of an adaptive TiN grid search, the likelihood is then '
+                             'only refined to --resolution around the MAP and CI bounds. 0 evaluates the full grid'
+                        , required=False, default=0)
+    parser.add_argument('--precision',
+                        help='floating point precision of the SSNV log conditionals and the aSCNA het log likelihoods. '
+                             'float32 halves their memory, the SSNV conditional probabilities stay float64',
+                        required=False, default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--precision_report',
+                        help='rerun the models in float64 and write the deviation of the --precision results to '
+                             'output_name.precision_report.txt', required=False, action='store_true')
+    parser.add_argument('--threads',
+                        help='number of workers the TiN likelihood kernels are partitioned across', required=False,
+                        default=1)
+    parser.add_argument('--executor',
+                        help='backend of the --threads workers. process places the kernel inputs in shared memory. '
+                             'The pool is started once per run. Results are identical to the serial run',
+                        required=False, default='thread',
+                        choices=['serial', 'thread', 'process'])
+    parser.add_argument('--genome_build',
+                        help='reference build of the input coordinates, used for the chromosome lengths of the linear '
+                             'genomic coordinates', required=False, default='GRCh38', choices=['hg19', 'GRCh38', 'hg38'])
+    parser.add_argument('--reference_index',
+                        help='.fai or sequence dictionary (.dict) of the reference. When given the chromosome lengths '
+                             'are read from it instead of the --genome_build table', required=False, default='None')
+    parser.add_argument('--centromere_telomere_distance',
+                        help='hets closer than this distance (bp) to a centromere or telomere of --genome_build are '
+                             'not used by the aSCNA model', required=False, default=5000000)
+    parser.add_argument('--het_coverage_threshold',
+                        help='number of reads (ALT_COUNT + REF_COUNT) required in both the tumor and the normal to use '
+                             'a het for TiN estimation', required=False, default=0)
+    parser.add_argument('--plots',
+                        help='plots to write: none, png only, or all (png and eps of the het and SSNV scatter plots). '
+                             'With --threads above 1 plots are drawn in separate processes while the results are written',
+                        required=False,
+                        default='all', choices=['none', 'png', 'all'])
+    parser.add_argument('--cache_dir',
+                        help='directory for the parsed cancer hot spot file and the germline site index converted from '
+                             'a legacy ExAC pickle, reused by later runs. Default: --output_dir', required=False,
+                        default='None')
+    parser.add_argument('--seed',
+                        help='seed of the random draw of hets dropped to balance the hets of aSCNA segments',
+                        required=False, default=1)
     args = parser.parse_args()
     if args.cn_data_path == 'NULL' and args.mutation_data_path == 'NULL':
         print('One of CN data or SSNV data are required.')
@@ -509,11 +534,15 @@ def main():
         di = input(args)
         di.read_and_preprocess_SSNVs()
 
-        di.candidates = du.select_candidate_mutations(di.call_stats_table, di.exac_db_file)
+        di.candidates = du.select_candidate_mutations(di.call_stats_table, di.exac_db_file, di.cache_dir)
         n_calls_pre = np.sum(di.candidates['judgement'] == "KEEP")
 
         ssnv_based_model = dssnv.model(di.candidates, di.mutation_prior, di.resolution, di.SSNV_af_threshold,
-                                       di.coverage_threshold, di.CancerHotSpotsBED, skew = di.skew)
+                                       di.coverage_threshold, di.CancerHotSpotsBED, skew = di.skew,
+                                       cache_dir=di.cache_dir,
+                                       max_memory=di.max_memory, coarse_resolution=di.coarse_resolution,
+                                       precision=di.precision, threads=di.threads, executor=di.executor,
+                                       genome=di.genome)
         ssnv_based_model.perform_inference()
         ascna_based_model = dascna.model(di.seg_table, di.het_table, di.resolution)
         ascna_based_model.TiN = np.nan
@@ -524,18 +553,23 @@ def main():
         di.candidates = pd.DataFrame(index=[0],columns=['contig', 'position', 'ref_allele', 'alt_allele', 'tumor_name', 'normal_name',
                 't_alt_count','t_ref_count', 'n_alt_count', 'n_ref_count', 'failure_reasons', 'judgement','genomic_coord_x','f_acs','tau'])
         ssnv_based_model = dssnv.model(di.candidates, di.mutation_prior, di.resolution, di.SSNV_af_threshold,
-                                       di.coverage_threshold, di.CancerHotSpotsBED)
+                                       di.coverage_threshold, di.CancerHotSpotsBED, max_memory=di.max_memory,
+                                       precision=di.precision, threads=di.threads, executor=di.executor,
+                                       genome=di.genome, cache_dir=di.cache_dir)
         ssnv_based_model.TiN = np.nan
         ascna = False
         # identify aSCNAs and filter hets
         if len(di.seg_table) > 0:
-            di.aSCNA_hets = du.ensure_balanced_hets(di.seg_table, di.het_table)
+            di.aSCNA_hets = du.ensure_balanced_hets(di.seg_table, di.het_table, di.seed)
             if len(di.aSCNA_hets) > 0:
                 di.aSCNA_segs, di.convergent_segs = du.identify_aSCNAs(di.seg_table, di.aSCNA_hets, di.aSCNA_thresh,
                                                                        di.ascna_SNP_number_filter,
                                                                        di.aSCNA_variance_threshold)
                 if len(di.aSCNA_segs) > 0:
-                    ascna_based_model = dascna.model(di.aSCNA_segs, di.aSCNA_hets, di.resolution)
+                    ascna_based_model = dascna.model(di.aSCNA_segs, di.aSCNA_hets, di.resolution,
+                                                     coarse_resolution=di.coarse_resolution,
+                                                     max_memory=di.max_memory, precision=di.precision,
+                                                     threads=di.threads, executor=di.executor)
                     ascna_based_model.perform_inference()
                     ascna = True
         if not ascna:
@@ -546,11 +580,14 @@ def main():
         di.read_and_preprocess_data()
         # identify candidate mutations based on MuTect flags.
         # kept sites are flagged as KEEP or rejected for normal lod and/or alt_allele_in_normal
-        di.candidates = du.select_candidate_mutations(di.call_stats_table, di.exac_db_file)
+        di.candidates = du.select_candidate_mutations(di.call_stats_table, di.exac_db_file, di.cache_dir)
         n_calls_pre = np.sum(di.candidates['judgement'] == "KEEP")
         # generate SSNV based model using candidate sites
         ssnv_based_model = dssnv.model(di.candidates, di.mutation_prior, di.resolution, di.SSNV_af_threshold,
-                                   di.coverage_threshold, di.CancerHotSpotsBED)
+                                   di.coverage_threshold, di.CancerHotSpotsBED, max_memory=di.max_memory,
+                                   coarse_resolution=di.coarse_resolution, precision=di.precision,
+                                   threads=di.threads, executor=di.executor, genome=di.genome,
+                                   cache_dir=di.cache_dir)
         ssnv_based_model.perform_inference()
         if di.only_ascnas == True:
             ssnv_based_model.TiN = np.nan
@@ -558,18 +595,38 @@ def main():
         ascna = False
         # identify aSCNAs and filter hets
         if len(di.seg_table) > 0:
-            di.aSCNA_hets = du.ensure_balanced_hets(di.seg_table, di.het_table)
+            di.aSCNA_hets = du.ensure_balanced_hets(di.seg_table, di.het_table, di.seed)
             if len(di.aSCNA_hets) > 0:
                 di.aSCNA_segs,di.convergent_segs = du.identify_aSCNAs(di.seg_table, di.aSCNA_hets, di.aSCNA_thresh, di.ascna_SNP_number_filter,
                                                di.aSCNA_variance_threshold)
                 if len(di.aSCNA_segs) > 0:
-                    ascna_based_model = dascna.model(di.aSCNA_segs, di.aSCNA_hets, di.resolution)
+                    ascna_based_model = dascna.model(di.aSCNA_segs, di.aSCNA_hets, di.resolution,
+                                                     coarse_resolution=di.coarse_resolution,
+                                                     max_memory=di.max_memory, precision=di.precision,
+                                                     threads=di.threads, executor=di.executor)
                     ascna_based_model.perform_inference()
                     ascna = True
         if not ascna:
             ascna_based_model = dascna.model(di.seg_table, di.het_table, di.resolution)
             ascna_based_model.TiN = np.nan
 
+    if di.precision_report:
+        # rerun the models in float64 to report the deviation of the reduced precision estimates
+        precision_report = []
+        if not np.isnan(ssnv_based_model.TiN):
+            reference_model = dssnv.model(di.candidates, di.mutation_prior, di.resolution, di.SSNV_af_threshold,
+                                          di.coverage_threshold, di.CancerHotSpotsBED, max_memory=di.max_memory,
+                                          coarse_resolution=di.coarse_resolution, threads=di.threads,
+                                          executor=di.executor, genome=di.genome, cache_dir=di.cache_dir)
+            reference_model.perform_inference()
+            precision_report.append(du.tolerance_report('SSNV', ssnv_based_model, reference_model))
+        if not np.isnan(ascna_based_model.TiN):
+            reference_model = dascna.model(di.aSCNA_segs, di.aSCNA_hets, di.resolution,
+                                           coarse_resolution=di.coarse_resolution, max_memory=di.max_memory,
+                                           threads=di.threads, executor=di.executor)
+            reference_model.perform_inference()
+            precision_report.append(du.tolerance_report('aSCNA', ascna_based_model, reference_model))
+
         # combine models and reclassify mutations
     do = output(di, ssnv_based_model, ascna_based_model)
     do.calculate_joint_estimate()
@@ -581,6 +638,18 @@ def main():
     # make output directory if needed
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
+    if not np.isnan(ascna_based_model.TiN):
+        do.ascna_based_model.segs['Chromosome'] = do.ascna_based_model.segs['Chromosome'] + 1
+    # with more than one CPU the plots render in a separate process pool while the results are written,
+    # the pool uses the CPUs left to this process. With --threads 1 they are drawn here
+    plot_pool = None
+    if di.plots != 'none' and di.threads > 1:
+        plot_pool = ProcessPoolExecutor(max_workers=min(di.threads - 1, 4))
+    plots = du.start_plots(do, di.plots, plot_pool)
+    if di.precision_report:
+        pd.DataFrame(precision_report).to_csv(
+            path_or_buf=do.input.output_path + '/' + do.input.output_name + '.precision_report.txt', sep='\t',
+            index=None)
     # write deTiN reclassified SSNVs
     do.SSNVs.to_csv(path_or_buf=do.input.output_path + '/' + do.input.output_name + '.deTiN_SSNVs.txt', sep='\t',
                     index=None)
@@ -590,16 +659,9 @@ def main():
         do.indels.drop('Chromosome', axis=1, inplace=True)
         do.indels.to_csv(path_or_buf=do.input.output_path + '/' + do.input.output_name + '.deTiN_indels.txt', sep='\t',
                          index=None)
-    # write plots
     if not np.isnan(ascna_based_model.TiN):
-        do.ascna_based_model.segs['Chromosome'] = do.ascna_based_model.segs['Chromosome'] + 1
         do.ascna_based_model.segs.to_csv(path_or_buf=do.input.output_path + '/' + do.input.output_name + '.deTiN_aSCNAs.txt', sep='\t',
                     index=None)
-        du.plot_kmeans_info(ascna_based_model, do.input.output_path, do.input.output_name)
-        du.plot_TiN_models(do)
-        du.plot_aSCNA_het_data(do)
-    if not np.isnan(ssnv_based_model.TiN):
-        du.plot_SSNVs(do)
     # write TiN and CIs
     file = open(do.input.output_path + '/' + do.input.output_name + '.TiN_estimate.txt', 'w')
     file.write('%s' % (do.TiN))
@@ -611,6 +673,14 @@ def main():
 
     file = open(do.input.output_path + '/' + do.input.output_name + '.number_of_SSNVs_added.txt','w')
     file.write('%s\n'% int(n_calls_added))
+    file.close()
+
+    # wait for the plots, raising any plotting error
+    for plot in plots:
+        plot.result()
+    if plot_pool is not None:
+        plot_pool.shutdown()
+    di.executor.shutdown()
 
 if __name__ == "__main__":
     main()
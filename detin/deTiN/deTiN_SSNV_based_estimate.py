@@ -1,7 +1,8 @@
+import time
 import numpy as np
-import pandas as pd
 from scipy.stats import beta
 import deTiN_utilities as du
+import deTiN_parallel as dpar
 
 np.seterr(all='ignore')
 
@@ -14,10 +15,24 @@ class model:
      TiN estimate : model.TiN
      Somatic classification of SSNVs : model.E_z (E_z > 0.5 -> somatic)"""
 
-    def __init__(self, candidate_sites, p_somatic, resolution=101, f_thresh=0.15, depth=15, hot_spots_file = 'NA', skew = 0.5):
+    def __init__(self, candidate_sites, p_somatic, resolution=101, f_thresh=0.15, depth=15, hot_spots_file = 'NA', skew = 0.5,
+                 max_memory=2, coarse_resolution=0, precision='float64', threads=1, executor='serial', genome=None,
+                 cache_dir=None):
         # variables follow notation:
         # ac = allele count n = normal t = tumor
 
+        # floating point type of the dense log conditionals of the M step
+        # the conditionals themselves are differences of beta cdfs which cancel and underflow in float32,
+        # so p_TiN_given_S and p_TiN_given_G stay float64 whatever the precision
+        self.dtype = np.dtype(precision)
+
+        # memory budget (GB) for the temporaries of the TiN grid kernel
+        self.max_memory = max_memory
+        # workers the TiN columns of the kernel are partitioned across
+        self.executor = dpar.as_executor(executor, threads)
+        # number of TiN values of the first pass of the adaptive grid search (0 evaluates the full grid)
+        self.coarse_resolution = coarse_resolution
+
         # Variables for SSNV fit
         self.TiN_range = np.linspace(0, 1, num=resolution)
         self.af = np.linspace(0.005, 1, num=200)
@@ -40,19 +55,15 @@ class model:
         # hyperparameter
         self.p_somatic = np.zeros([self.number_of_sites,1]) + p_somatic
         if hot_spots_file != 'NA':
-            hot_spots = pd.read_csv(hot_spots_file,sep='\t',low_memory=False,index_col=False)
-            if type(hot_spots['Chromosome'][0]) == str:
-                hot_spots['contig'] = du.chr2num(np.array(hot_spots['Chromosome']))
-            else:
-                hot_spots['contig'] = np.array(hot_spots['Chromosome']) - 1
-            hot_spots = hot_spots[np.isfinite(hot_spots['contig'])]
-            hot_spots['genomic_coord_x'] = du.hg19_to_linear_positions(
-                np.array(hot_spots['contig']), np.array(hot_spots['Position']))
-            for index,hot_spot in hot_spots.iterrows():
-                if np.size(np.where(self.genomic_coord_x==hot_spot['genomic_coord_x'])) > 0:
-                    print('Using user provided probabilities for cancer hot spots:')
-                    print(hot_spot['Chromosome'] + ' ' + hot_spot['Position'])
-                    self.p_somatic[np.where(self.genomic_coord_x==hot_spot['genomic_coord_x'])] = hot_spot['Probability']
+            # single sorted join of the candidate sites against the hot spot index
+            hot_spots = du.load_hot_spot_index(hot_spots_file, genome, cache_dir)
+            hot_spot_idx = du.sorted_lookup(hot_spots['genomic_coord_x'], np.array(self.genomic_coord_x))
+            is_hot_spot = hot_spot_idx >= 0
+            if np.any(is_hot_spot):
+                print('Using user provided probabilities for cancer hot spots:')
+                for i in np.unique(hot_spot_idx[is_hot_spot]):
+                    print(str(hot_spots['Chromosome'][i]) + ' ' + str(hot_spots['Position'][i]))
+                self.p_somatic[is_hot_spot, 0] = hot_spots['Probability'][hot_spot_idx[is_hot_spot]]
 
         # parameter
         self.TiN = 0
@@ -79,82 +90,220 @@ class model:
         # conditionals
         self.p_TiN_given_S = np.zeros([self.number_of_sites, resolution])
         self.p_TiN_given_G = np.zeros([self.number_of_sites, resolution])
-        self.p_TiN_given_het = np.zeros([self.number_of_sites, resolution])
         self.p_artifact = np.zeros([self.number_of_sites, 1])
+        # TiN columns of the conditionals which have been computed
+        self.evaluated_tin = np.zeros(resolution, dtype=bool)
+        self.site_to_unique = None
+        # dense log conditionals of the candidate sites used by the M step
+        self.log_S_minus_G = None
+        self.log_G_total = None
+        self.log_evaluated_tin = np.zeros(resolution, dtype=bool)
+
+        # EM convergence diagnostics of the last EM run
+        self.em_iterations = 0
+        self.em_iteration_times = []
 
         # likelihood
         self.TiN_likelihood = np.zeros([resolution, 1])
 
-    def generate_conditional_ps(self):
-        # p(TiN|Somatic) and p(TiN|Germline)
-        t_het_direction = np.ones([self.number_of_sites, len(self.af)])
-        t_het_direction[:, 0:np.int(np.round(np.true_divide(len(self.af), 2)))] = -1
-        self.afexp = np.repeat(np.expand_dims(self.af, 1), self.number_of_sites, axis=1).T
-        t_af_w = beta._cdf(self.afexp, np.expand_dims(self.t_alt_count + 1, 1),
-                           np.expand_dims(self.t_ref_count + 1, 1)) - beta._cdf(self.afexp - 0.005,
-                                                                                np.expand_dims(self.t_alt_count + 1, 1),
-                                                                                np.expand_dims(self.t_ref_count + 1, 1))
+    def unique_observations(self):
+        # the conditionals of a site only depend on its allele counts and copy number (tau)
+        # returns one representative site per unique observation and the map from sites to observations
+        observations = np.column_stack([self.t_alt_count, self.t_ref_count, self.n_alt_count, self.n_ref_count,
+                                        np.array(self.tau, dtype=float)]).astype(float)
+        _, unique_idx, site_to_unique = np.unique(observations, axis=0, return_index=True, return_inverse=True)
+        return unique_idx, site_to_unique.reshape(-1)
+
+    def prepare_observations(self):
+        # per observation terms of the conditionals which do not depend on TiN
+        # computed once per unique allele count observation and scattered back to all sites
+        unique_idx, self.site_to_unique = self.unique_observations()
+        self.n_unique_observations = len(unique_idx)
+        self.observation_compression = np.true_divide(self.number_of_sites, max(self.n_unique_observations, 1))
+        print('computing SSNV conditionals for ' + str(self.n_unique_observations) + ' unique observations from ' +
+              str(self.number_of_sites) + ' sites (' + str(np.round(self.observation_compression, 2)) + 'x compression)')
+        t_alt_count = self.t_alt_count[unique_idx]
+        t_ref_count = self.t_ref_count[unique_idx]
+        self.unique_n_depth = self.n_depth[unique_idx]
+        self.unique_normal_f = self.normal_f[unique_idx]
+        self.unique_CN_ratio = self.CN_ratio[unique_idx, :]
 
-        f_t_af = self.skew - np.abs(self.skew - self.afexp)
-        t_af = np.multiply(self.afexp, np.expand_dims(self.n_depth, 1))
+        t_het_direction = np.ones([self.n_unique_observations, len(self.af)])
+        t_het_direction[:, 0:int(np.round(np.true_divide(len(self.af), 2)))] = -1
+        afexp = np.repeat(np.expand_dims(self.af, 1), self.n_unique_observations, axis=1).T
+        self.t_af_w = beta._cdf(afexp, np.expand_dims(t_alt_count + 1, 1),
+                                np.expand_dims(t_ref_count + 1, 1)) - beta._cdf(afexp - 0.005,
+                                                                                np.expand_dims(t_alt_count + 1, 1),
+                                                                                np.expand_dims(t_ref_count + 1, 1))
+
+        f_t_af = self.skew - np.abs(self.skew - afexp)
+        self.t_af = np.multiply(afexp, np.expand_dims(self.unique_n_depth, 1))
 
         psi_t_af = self.skew - f_t_af
-        psi_t_af = np.multiply(psi_t_af, t_het_direction)
-        for TiN_idx, TiN in enumerate(self.TiN_range):
-            n_ac_given_tin = np.multiply(t_af, np.expand_dims(self.CN_ratio[:, TiN_idx], 1))
-            exp_f = self.skew + np.multiply(psi_t_af, np.expand_dims(self.CN_ratio[:, TiN_idx], 1))
-            n_het_ac_given_tin = np.multiply(exp_f, self.n_depth[:, np.newaxis])
-
-            self.p_TiN_given_S[:, TiN_idx] += np.sum(
-                np.multiply(beta._cdf(np.expand_dims(self.normal_f[:] + .01, 1), n_ac_given_tin + 1,
-                                      self.n_depth[:, np.newaxis] - n_ac_given_tin + 1) -
-                            beta._cdf(np.expand_dims(self.normal_f[:], 1), n_ac_given_tin + 1,
-                                      self.n_depth[:, np.newaxis] - n_ac_given_tin + 1), t_af_w), axis=1)
-            self.p_TiN_given_het[:, TiN_idx] += np.sum(
-                np.multiply(beta._cdf(np.expand_dims(self.normal_f[:] + .01, 1), n_het_ac_given_tin + 1,
-                                      self.n_depth[:, np.newaxis] - n_het_ac_given_tin + 1) -
-                            beta._cdf(np.expand_dims(self.normal_f[:], 1), n_het_ac_given_tin + 1,
-                                      self.n_depth[:, np.newaxis] - n_het_ac_given_tin + 1), t_af_w), axis=1)
+        self.psi_t_af = np.multiply(psi_t_af, t_het_direction)
         self.p_artifact = beta._cdf(self.normal_f + .01, self.t_alt_count + 1, self.t_ref_count + 1) - beta._cdf(
             self.normal_f, self.t_alt_count + 1, self.t_ref_count + 1)
-        self.p_TiN_given_G = np.multiply(1 - self.p_artifact[:, np.newaxis], self.p_TiN_given_het) + np.multiply(
-            self.p_artifact[:, np.newaxis], 1 - self.p_TiN_given_het)
+
+    def generate_conditional_ps(self, tin_idx=None):
+        # p(TiN|Somatic) and p(TiN|Germline) at the TiN columns tin_idx (default all columns)
+        # columns which have already been computed are skipped
+        if self.site_to_unique is None:
+            self.prepare_observations()
+        if tin_idx is None:
+            tin_idx = np.arange(len(self.TiN_range))
+        tin_idx = np.unique(np.array(tin_idx, dtype=int))
+        tin_idx = tin_idx[~self.evaluated_tin[tin_idx]]
+        if len(tin_idx) == 0:
+            return
+        # evaluate as many TiN columns per call as fit in the memory budget shared by the workers
+        p_TiN_given_S = np.zeros([self.n_unique_observations, len(tin_idx)])
+        p_TiN_given_het = np.zeros([self.n_unique_observations, len(tin_idx)])
+        block_size = min(du.grid_points_per_block(self.n_unique_observations * len(self.af),
+                                                  np.true_divide(self.max_memory, self.executor.threads)),
+                         int(np.ceil(np.true_divide(len(tin_idx), self.executor.threads))))
+        inputs = {'CN_ratio': self.unique_CN_ratio[:, tin_idx], 'n_depth': self.unique_n_depth,
+                  'normal_f': self.unique_normal_f, 't_af': self.t_af, 'psi_t_af': self.psi_t_af,
+                  't_af_w': self.t_af_w, 'skew': np.array(self.skew, dtype=float)}
+        outputs = {'p_S': p_TiN_given_S, 'p_het': p_TiN_given_het}
+        self.executor.run(conditional_ps_task, dpar.column_blocks(len(tin_idx), block_size), inputs, outputs)
+        self.p_TiN_given_S[:, tin_idx] = p_TiN_given_S[self.site_to_unique, :]
+        # p(TiN|het) is only needed for p(TiN|Germline) and is not kept per site
+        p_TiN_given_het = p_TiN_given_het[self.site_to_unique, :]
+        self.p_TiN_given_G[:, tin_idx] = np.multiply(1 - self.p_artifact[:, np.newaxis],
+                                                     p_TiN_given_het) + np.multiply(
+            self.p_artifact[:, np.newaxis], 1 - p_TiN_given_het)
+        self.evaluated_tin[tin_idx] = True
+
+    def E_z_given_TiN(self, tin_idx):
+        # p(somatic) of each site given the TiN value at index tin_idx
+        numerator = self.p_somatic * np.expand_dims(self.p_TiN_given_S[:, tin_idx],1)
+        denominator = numerator + (1 - self.p_somatic) * np.expand_dims(np.nan_to_num(self.p_TiN_given_G[:, tin_idx]),1)
+        return np.nan_to_num(np.true_divide(numerator, denominator))
 
     def expectation_of_z_given_TiN(self):
         # E step
-        numerator = self.p_somatic * np.expand_dims(self.p_TiN_given_S[:, self.TiN],1)
-        denominator = numerator + (1 - self.p_somatic) * np.expand_dims(np.nan_to_num(self.p_TiN_given_G[:, self.TiN]),1)
-        self.E_z = np.nan_to_num(np.true_divide(numerator, denominator))
+        self.E_z = self.E_z_given_TiN(self.TiN)
+
+    def p_somatic_given_TiN_weights(self, tin_weights, min_weight=0.001):
+        # p(somatic) of each site integrated over TiN with one weight per TiN bin (e.g. the TiN posterior)
+        # computed as weighted matrix products over the bins with weight > min_weight
+        tin_weights = np.ravel(tin_weights)
+        tin_idx = np.where(tin_weights > min_weight)[0]
+        self.generate_conditional_ps(tin_idx)
+        numerator = self.p_somatic[:, 0] * np.dot(self.p_TiN_given_S[:, tin_idx], tin_weights[tin_idx])
+        denominator = numerator + (1 - self.p_somatic[:, 0]) * np.dot(
+            np.nan_to_num(self.p_TiN_given_G[:, tin_idx]), tin_weights[tin_idx])
+        return np.nan_to_num(np.true_divide(numerator, denominator))
+
+    def update_log_conditionals(self):
+        # log p(TiN|S) and log p(TiN|G) of the candidate sites, computed once per evaluated TiN column
+        # stored as log p(TiN|S) - log p(TiN|G) and the column sums of log p(TiN|G) so that the
+        # M step likelihood E_z * log p(TiN|S) + (1 - E_z) * log p(TiN|G) is a single matrix-vector product
+        if self.log_S_minus_G is None:
+            self.log_S_minus_G = np.zeros([np.sum(self.candidate_sites), len(self.TiN_range)], dtype=self.dtype)
+            self.log_G_total = np.zeros(len(self.TiN_range))
+        tin_idx = np.where(np.logical_and(self.evaluated_tin, ~self.log_evaluated_tin))[0]
+        if len(tin_idx) == 0:
+            return
+        log_S = np.log(self.p_TiN_given_S[self.candidate_sites][:, tin_idx])
+        log_G = np.log(self.p_TiN_given_G[self.candidate_sites][:, tin_idx])
+        # sites with p = 0 (or undefined p) do not contribute to the likelihood of a TiN value
+        # a TiN value without any contributing site has likelihood -inf
+        no_support = np.logical_or(~np.any(np.isfinite(log_S), axis=0), ~np.any(np.isfinite(log_G), axis=0))
+        log_S[~np.isfinite(log_S)] = 0
+        log_G[~np.isfinite(log_G)] = 0
+        self.log_S_minus_G[:, tin_idx] = log_S - log_G
+        self.log_G_total[tin_idx] = np.sum(log_G, axis=0)
+        if len(log_G) > 0:
+            self.log_G_total[tin_idx[no_support]] = -np.inf
+        self.log_evaluated_tin[tin_idx] = True
+
+    def TiN_likelihood_given_E_z(self, E_z):
+        # TiN values whose conditionals were not computed are interpolated from the evaluated ones
+        self.update_log_conditionals()
+        TiN_likelihood = du.blocked_dot(E_z[self.candidate_sites, 0], self.log_S_minus_G) + self.log_G_total
+        return du.interpolate_tin_likelihood(TiN_likelihood, self.evaluated_tin)
+
     def maximize_TiN_likelihood(self):
         # M step
-        self.TiN_likelihood = np.nansum(np.multiply(self.E_z[self.candidate_sites],
-                                                    np.ma.log(self.p_TiN_given_S[self.candidate_sites, :])), axis=0) + \
-                              np.nansum(np.multiply(1 - self.E_z[self.candidate_sites],
-                                                    np.ma.log(self.p_TiN_given_G[self.candidate_sites, :])), axis=0)
+        self.TiN_likelihood = self.TiN_likelihood_given_E_z(self.E_z)
         self.TiN = np.argmax(self.TiN_likelihood)
 
-    def perform_inference(self):
-        # perform EM procedure over
-        print('pre-processing SSNV data')
-        self.generate_conditional_ps()
-        TiN_last = []
+    def fixed_TiN_likelihood(self, tin_idx=0):
+        # TiN likelihood after one E and M step with TiN fixed at the index tin_idx (TiN = 0 is the null hypothesis)
+        # TiN, E_z and TiN_likelihood of the model are left unchanged
+        self.generate_conditional_ps([tin_idx])
+        return self.TiN_likelihood_given_E_z(self.E_z_given_TiN(tin_idx))
+
+    def run_em(self):
+        TiN_last = None
         iteration = 0
-        print('initialized TiN to 0')
+        self.em_iteration_times = []
         while self.TiN != TiN_last and iteration <= 100:
             iteration += 1
             TiN_last = self.TiN
+            start = time.time()
             self.expectation_of_z_given_TiN()
             self.maximize_TiN_likelihood()
+            self.em_iteration_times.append(time.time() - start)
             print('TiN inference after ' + str(iteration) + ' iterations = ' + str(self.TiN_range[self.TiN]))
+        self.em_iterations = iteration
+        print('EM finished after ' + str(self.em_iterations) + ' iterations (' +
+              str(np.round(1000 * np.mean(self.em_iteration_times), 3)) + ' ms per iteration)')
+
+    def perform_inference(self):
+        # perform EM procedure over
+        print('pre-processing SSNV data')
+        if self.coarse_resolution > 0:
+            # adaptive grid: start from a coarse TiN grid and refine around the MAP and CI bounds
+            self.generate_conditional_ps(du.coarse_tin_grid(len(self.TiN_range), self.coarse_resolution))
+        else:
+            self.generate_conditional_ps()
+        print('initialized TiN to 0')
+        self.run_em()
+        while self.coarse_resolution > 0:
+            refine_idx = du.tin_refinement_grid(self.TiN_likelihood, self.evaluated_tin, self.coarse_resolution)
+            if len(refine_idx) == 0:
+                break
+            print('refining SSNV TiN likelihood at ' + str(len(refine_idx)) + ' TiN values')
+            self.generate_conditional_ps(refine_idx)
+            # restart EM from TiN = 0 as in the full grid search
+            self.TiN = 0
+            self.run_em()
         print('SSNV based TiN estimate converged: TiN = ' + str(self.TiN_range[self.TiN]) + ' based on ' + str(np.sum(self.candidate_sites)) + ' sites')
         self.TiN = self.TiN_range[self.TiN]
 
-        posterior = np.exp(self.TiN_likelihood - np.nanmax(self.TiN_likelihood))
-        self.CI_tin_low = self.TiN_range[
-            next(x[0] for x in
-                 enumerate(np.cumsum(np.ma.masked_array((np.true_divide(posterior, np.nansum(posterior))))))
-                 if x[1] > 0.025)]
-        self.CI_tin_high = self.TiN_range[
-            next(x[0] for x in
-                 enumerate(np.cumsum(np.ma.masked_array((np.true_divide(posterior, np.nansum(posterior))))))
-                 if x[1] > 0.975)]
+        _, _, ci_low, ci_high = du.tin_posterior_summary(self.TiN_likelihood)
+        self.CI_tin_low = self.TiN_range[ci_low[0]]
+        self.CI_tin_high = self.TiN_range[ci_high[0]]
+
+
+def conditional_ps_task(block, inputs, outputs):
+    # conditionals of the TiN columns start:stop of generate_conditional_ps
+    start, stop = block
+    outputs['p_S'][:, start:stop], outputs['p_het'][:, start:stop] = conditional_ps_block(
+        inputs['CN_ratio'][:, start:stop], inputs['n_depth'], inputs['normal_f'], inputs['t_af'], inputs['psi_t_af'],
+        inputs['t_af_w'], float(inputs['skew']))
+
+
+def conditional_ps_block(CN_ratio, n_depth, normal_f, t_af, psi_t_af, t_af_w, skew):
+    # p(TiN|Somatic) and p(TiN|het) for a block of TiN columns of CN_ratio
+    # temporaries are sites x TiN columns x allele fractions
+    cn_ratio = CN_ratio[:, :, np.newaxis]
+    n_depth = n_depth[:, np.newaxis, np.newaxis]
+    normal_f = normal_f[:, np.newaxis, np.newaxis]
+    t_af_w = t_af_w[:, np.newaxis, :]
+
+    n_ac_given_tin = np.multiply(t_af[:, np.newaxis, :], cn_ratio)
+    p_S = np.sum(
+        np.multiply(beta._cdf(normal_f + .01, n_ac_given_tin + 1, n_depth - n_ac_given_tin + 1) -
+                    beta._cdf(normal_f, n_ac_given_tin + 1, n_depth - n_ac_given_tin + 1), t_af_w), axis=2)
+    del n_ac_given_tin
+
+    exp_f = skew + np.multiply(psi_t_af[:, np.newaxis, :], cn_ratio)
+    n_het_ac_given_tin = np.multiply(exp_f, n_depth)
+    del exp_f
+    p_het = np.sum(
+        np.multiply(beta._cdf(normal_f + .01, n_het_ac_given_tin + 1, n_depth - n_het_ac_given_tin + 1) -
+                    beta._cdf(normal_f, n_het_ac_given_tin + 1, n_depth - n_het_ac_given_tin + 1), t_af_w), axis=2)
+    return p_S, p_het
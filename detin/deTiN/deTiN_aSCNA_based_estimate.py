@@ -1,11 +1,11 @@
 from __future__ import division
 import numpy as np
 from scipy.stats import beta
-from scipy.cluster.vq import kmeans
 from scipy.stats import mode
 from itertools import combinations
 import pandas as pd
 import deTiN_utilities as du
+import deTiN_parallel as dpar
 
 
 np.seterr(all='ignore')
@@ -17,14 +17,30 @@ class model:
        only usable when tumors have sufficient allele imbalance (>200 probes and >10 SNPs under loh).
         TiN estimate : model.TiN"""
 
-    def __init__(self, aSCNA_segs, aSCNA_hets, resolution = 101):
+    def __init__(self, aSCNA_segs, aSCNA_hets, resolution = 101, coarse_resolution = 0, max_memory = 2,
+                 precision = 'float64', threads = 1, executor = 'serial'):
 
         # input data
         self.segs = aSCNA_segs.copy()
+        # segment ids referenced by the seg_id column of the hets
+        self.seg_ids = np.array(self.segs.index)
         self.hets = aSCNA_hets.copy()
         self.n_segs = self.segs.shape[0]
         self.n_hets = self.hets.shape[0]
+        # hets sorted by segment once: the hets of segment seg_ids[i] are het_order[seg_offsets[i]:seg_offsets[i + 1]]
+        # hets of segments which are not in the segment table have het_seg = -1 and come before all offsets
+        self.het_seg = pd.Index(self.seg_ids).get_indexer(self.hets['seg_id'])
+        self.het_order = np.argsort(self.het_seg, kind='stable')
+        self.seg_offsets = np.searchsorted(self.het_seg[self.het_order], np.arange(self.n_segs + 1))
         self.resolution = resolution
+        # number of TiN values of the first pass of the adaptive grid search (0 evaluates the full grid)
+        self.coarse_resolution = coarse_resolution
+        # memory budget (GB) for the temporaries of the TiN grid kernel
+        self.max_memory = max_memory
+        # workers the TiN columns of the kernel are partitioned across
+        self.executor = dpar.as_executor(executor, threads)
+        # floating point type of the stored (hets x TiN) likelihoods
+        self.dtype = np.dtype(precision)
         # Variables for fit
         self.TiN_range = np.linspace(0, 1, num=resolution)
         self.af = np.linspace(0.005, 1, num=200)
@@ -35,8 +51,14 @@ class model:
         self.tau = self.hets['tau']
         self.tin_correct_tau = np.multiply(self.TiN_range, self.hets['tau'][:, np.newaxis])
         self.tin_correct_normal_tau = np.multiply((1 - self.TiN_range), 2)
-        self.CN_ratio = np.divide(self.tin_correct_tau, np.array(self.tin_correct_tau + self.tin_correct_normal_tau))
-        self.p_TiN = np.zeros([self.n_hets, len(self.TiN_range)])
+        self.CN_ratio = np.divide(self.tin_correct_tau, np.array(self.tin_correct_tau + self.tin_correct_normal_tau)).astype(
+            self.dtype, copy=False)
+        # likelihood of each het relative to its TiN = 0 likelihood, the TiN independent remainder is kept
+        # in float64 in p_TiN_offset so that p_TiN only holds small numbers (stable in float32)
+        # TiN values which have not been evaluated stay at -inf
+        self.p_TiN = np.zeros([self.n_hets, len(self.TiN_range)], dtype=self.dtype) - np.inf
+        self.p_TiN_offset = np.zeros(self.n_hets)
+        self.evaluated_tin = np.zeros(resolution, dtype=bool)
         self.seg_likelihood = dict()
         self.TiN_likelihood_matrix = np.zeros([self.n_segs, resolution])
         self.reporting_cluster = 'mode'
@@ -50,7 +72,13 @@ class model:
         self.bic = np.zeros([3, 1])
         self.cluster_TiN_likelihoods = []
 
-    def calculate_TiN_likelihood(self):
+    def calculate_TiN_likelihood(self, tin_idx=None):
+        # likelihood of the TiN values tin_idx (default all) for each het and segment
+        # TiN values which have already been evaluated are skipped
+        if tin_idx is None:
+            tin_idx = np.arange(self.resolution)
+        tin_idx = np.unique(np.array(tin_idx, dtype=int))
+        tin_idx = tin_idx[~self.evaluated_tin[tin_idx]]
         self.t_alt_count = np.expand_dims(self.hets['ALT_COUNT_T'].values,1)
         self.t_ref_count = np.expand_dims(self.hets['REF_COUNT_T'].values,1)
         self.afexp = np.repeat(np.expand_dims(self.af, 1), self.n_hets, axis=1).T
@@ -60,62 +88,92 @@ class model:
         psi_t_af = np.multiply(psi_t_af, np.expand_dims(self.hets['d'], 1))
         self.n_alt_count = np.squeeze(self.hets['ALT_COUNT_N'].values)
         self.n_ref_count = np.squeeze(self.hets['REF_COUNT_N'].values)
-        self.p_TiN = np.zeros([self.n_hets, self.resolution])
-        for i, f in enumerate(self.af):
-            exp_f = self.mu_af_n + np.multiply(np.expand_dims(psi_t_af[:, i], 1), self.CN_ratio)
-            exp_f[exp_f < 0] = 0
-            exp_f[exp_f > 1] = 1
-            a = exp_f*(self.t_alt_count+self.t_ref_count)
-            b = (self.t_alt_count+self.t_ref_count) - a
-            self.p_TiN += du.beta_binomial_pdf(self.n_alt_count,self.n_alt_count+self.n_ref_count,
-                                           a+1,b+1) + t_af_w[:, i].reshape(-1,1)
-        seg_var = np.zeros([self.n_segs, 1])
-        TiN_MAP = np.zeros([self.n_segs, 1], dtype=int)
-        TiN_ci_h = np.zeros([self.n_segs, 1], dtype=int)
-        TiN_ci_l = np.zeros([self.n_segs, 1], dtype=int)
+        t_depth = self.t_alt_count + self.t_ref_count
+        # at TiN = 0 the expected allele fraction is mu_af_n whatever the allele fraction in the tumor
+        a = self.mu_af_n * t_depth
+        kernel = du.beta_binomial_kernel(self.n_alt_count.reshape(-1, 1),
+                                         (self.n_alt_count + self.n_ref_count).reshape(-1, 1))
+        zero_tin_likelihood = kernel.logpdf(a + 1, t_depth - a + 1)
+        zero_tin_terms = kernel.tin_terms(a + 1, t_depth - a + 1)
+        zero_tin_terms[~np.isfinite(zero_tin_likelihood)] = 0
+        zero_tin_likelihood[~np.isfinite(zero_tin_likelihood)] = 0
+        self.p_TiN_offset = np.sum(t_af_w, axis=1) + len(self.af) * zero_tin_likelihood[:, 0]
+        # the kernel is evaluated in float64 in blocks of TiN columns which fit in the memory budget
+        # (float32 gammaln differences lose ~0.1 log units per het), its inputs and outputs stay in the
+        # precision of p_TiN and are converted one block at a time
+        # the TiN columns are partitioned across the workers of the executor
+        block_size = min(du.grid_points_per_block(self.n_hets, np.true_divide(self.max_memory, self.executor.threads)),
+                         int(np.ceil(np.true_divide(len(tin_idx), self.executor.threads))))
+        # allele fraction points of the tumor evaluated together by the kernel within the same budget
+        af_block = min(du.grid_points_per_block(self.n_hets * max(block_size, 1),
+                                                np.true_divide(self.max_memory, self.executor.threads)), len(self.af))
+        inputs = {'CN_ratio': self.CN_ratio[:, tin_idx], 'psi_t_af': psi_t_af,
+                  't_depth': t_depth, 'n_alt_count': self.n_alt_count,
+                  'n_depth': self.n_alt_count + self.n_ref_count, 'zero_tin_terms': zero_tin_terms,
+                  'mu_af_n': np.array(self.mu_af_n, dtype=float), 'af_block': np.array(af_block)}
+        outputs = {'p_TiN': np.zeros([self.n_hets, len(tin_idx)], dtype=self.dtype)}
+        self.executor.run(het_likelihood_task, dpar.column_blocks(len(tin_idx), block_size), inputs, outputs)
+        self.p_TiN[:, tin_idx] = outputs['p_TiN']
+        self.evaluated_tin[tin_idx] = True
+        # per segment sums (nansum) of the het likelihoods and variance of the het MAP TiN values
+        seg_log_likelihood = self.segment_sums(np.where(np.isnan(self.p_TiN), 0, self.p_TiN), dtype=np.float64) + \
+            self.segment_sums(self.p_TiN_offset)[:, np.newaxis]
+        seg_var = self.segment_variances(np.argmax(self.p_TiN, 1).astype(float))[:, np.newaxis]
         TiN_likelihood = np.zeros([self.n_segs, self.resolution])
-        TiN_post = np.zeros([self.n_segs, self.resolution])
-        counter = 0
-        for seg_id, seg in self.segs.iterrows():
-            self.seg_likelihood[seg_id] = np.nansum(
-                self.p_TiN[self.hets['seg_id'] == seg_id], axis=0)
-            seg_var[counter] = np.nanvar(
-                np.argmax(self.p_TiN[self.hets['seg_id'] == seg_id], 1))
-            TiN_MAP[counter] = np.nanargmax(self.seg_likelihood[seg_id])
-            TiN_likelihood[counter, :] = np.nansum(self.p_TiN[np.array(self.hets['seg_id'] == seg_id, dtype=bool)],
-                                                axis=0)
-            prior = np.true_divide(np.ones([1, self.resolution]), self.resolution)
-            TiN_post[counter, :] = TiN_likelihood[counter, :] + np.log(prior)
-            TiN_post[counter, :] = TiN_post[counter, :] - np.max(TiN_post[counter, :])
-            TiN_post[counter, :] = np.exp(TiN_post[counter, :])
-            TiN_post[counter, :] = np.true_divide(TiN_post[counter, :], np.nansum(TiN_post[counter, :]))
-            TiN_ci_l[counter, :] = self.TiN_range[list(map(lambda x: x>0.025, np.cumsum(TiN_post[counter, :]))).index(True)]*100
-            TiN_ci_h[counter, :] = self.TiN_range[list(map(lambda x: x>0.975, np.cumsum(TiN_post[counter, :]))).index(True)]*100
-            counter += 1
+        for counter, seg_id in enumerate(self.seg_ids):
+            self.seg_likelihood[seg_id] = du.interpolate_tin_likelihood(seg_log_likelihood[counter], self.evaluated_tin)
+            TiN_likelihood[counter, :] = self.seg_likelihood[seg_id]
+        # posterior, MAP and CI of all segments at once (uniform prior)
+        TiN_post, TiN_MAP, TiN_ci_l, TiN_ci_h = du.tin_posterior_summary(TiN_likelihood)
         self.TiN_post_seg = TiN_post
         self.segs.loc[:, ('TiN_var')] = seg_var
         self.segs.loc[:, ('TiN_MAP')] = self.TiN_range[TiN_MAP] * 100
         self.TiN_likelihood_matrix = TiN_likelihood
-        self.segs.loc[:,('TiN_ci_h')] = TiN_ci_h
-        self.segs.loc[:, ('TiN_ci_l')] = TiN_ci_l
+        self.segs.loc[:,('TiN_ci_h')] = (self.TiN_range[TiN_ci_h] * 100).astype(int)
+        self.segs.loc[:, ('TiN_ci_l')] = (self.TiN_range[TiN_ci_l] * 100).astype(int)
+
+    def segment_sums(self, values, dtype=None):
+        # sums over the hets of each segment of values with one row per het (0 for segments without hets)
+        counts = np.diff(self.seg_offsets)
+        sums = np.zeros((self.n_segs,) + values.shape[1:], dtype=dtype if dtype is not None else values.dtype)
+        if np.any(counts > 0):
+            # reduceat sums from each start to the next one, so it is only given the starts of the segments
+            # with hets (the last of them ends at the end of the hets since seg_offsets[-1] == n_hets)
+            sums[counts > 0] = np.add.reduceat(values[self.het_order], self.seg_offsets[:-1][counts > 0], axis=0,
+                                               dtype=dtype)
+        return sums
+
+    def segment_variances(self, values):
+        # nanvar of values (one per het) over the hets of each segment
+        values = np.array(values, dtype=float)
+        present = self.segment_sums(~np.isnan(values), dtype=float)
+        values_or_0 = np.where(np.isnan(values), 0, values)
+        means = np.true_divide(self.segment_sums(values_or_0), present)
+        deviation = np.where(np.isnan(values), 0, values - means[self.het_seg])
+        return np.true_divide(self.segment_sums(np.power(deviation, 2)), present)
+
     def cluster_segments(self):
         if self.n_segs >= 3:
             K = range(1, 4)
             N = len(self.hets['seg_id'])
-            self.segs.reset_index(inplace=True, drop=False)
+            if 'index' not in self.segs.columns:
+                self.segs.reset_index(inplace=True, drop=False)
             tin_data = np.nanargmax(self.TiN_likelihood_matrix,axis=1).astype(float)
-            km = [kmeans(tin_data, k, iter=1000) for k in K]
+            km = [du.kmeans_1d(tin_data, k) for k in K]
             centroids = [cent for (cent, var) in km]
             squared_distance_to_centroids = [np.power(np.subtract(tin_data[:, np.newaxis], cent), 2) for cent in
                                              centroids]
             self.sum_squared_distance = [sum(np.min(d, axis=1)) / N for d in squared_distance_to_centroids]
             cluster_assignment = [np.argmin(d, axis=1) for d in squared_distance_to_centroids]
             het_tin_map = np.argmax(self.p_TiN, axis=1)
+            # squared distance of the het MAP TiN values to the centroid of the cluster of their segment
+            # summed per cluster over the hets of the segment table
+            in_segs = self.het_seg >= 0
             self.cl_distance_points = np.zeros([3, 3])
             for k, clust in enumerate(cluster_assignment):
-                for idx, row in self.segs.iterrows():
-                    self.cl_distance_points[k, clust[idx]] += np.sum(
-                        np.power(het_tin_map[self.hets['seg_id'] == row['index']] - centroids[k][clust[idx]], 2))
+                het_cluster = clust[self.het_seg[in_segs]]
+                self.cl_distance_points[k, :] = np.bincount(
+                    het_cluster, weights=np.power(het_tin_map[in_segs] - centroids[k][het_cluster], 2), minlength=3)
 
             self.cl_var = np.sqrt(
                 np.true_divide(self.cl_distance_points, len(self.hets['seg_id'])))
@@ -155,11 +213,38 @@ class model:
         print('calculating aSCNA based TiN estimate using data from chromosomes: ' + str(
             np.unique(self.segs['Chromosome']) +1))
         # calculate likelihood function for TiN in each segment
-        self.calculate_TiN_likelihood()
+        if self.coarse_resolution > 0:
+            # adaptive grid: start from a coarse TiN grid and refine around the MAP and CI bounds
+            self.calculate_TiN_likelihood(du.coarse_tin_grid(self.resolution, self.coarse_resolution))
+        else:
+            self.calculate_TiN_likelihood()
         # perform k-means clustering on TiN segment data
         self.cluster_segments()
+        self.select_cluster()
+        while self.coarse_resolution > 0:
+            # the joint estimate can reselect any cluster so all cluster likelihoods are refined
+            refine_idx = du.tin_refinement_grid([self.TiN_likelihood] + list(self.cluster_TiN_likelihoods),
+                                                self.evaluated_tin, self.coarse_resolution)
+            if len(refine_idx) == 0:
+                break
+            print('refining aSCNA TiN likelihood at ' + str(len(refine_idx)) + ' TiN values')
+            self.calculate_TiN_likelihood(refine_idx)
+            self.cluster_segments()
+            self.select_cluster()
+        _, tin_map, ci_low, ci_high = du.tin_posterior_summary(self.TiN_likelihood)
+        self.TiN = self.TiN_range[tin_map[0]]
+        self.CI_tin_low = self.TiN_range[ci_low[0]]
+        self.CI_tin_high = self.TiN_range[ci_high[0]]
         if np.max(self.cluster_assignment) > 0:
             print('detected ' + str(np.max(self.cluster_assignment) + 1) + ' clusters')
+            print('aSCNA based TiN estimate from selected TiN cluster :  ' + str(self.TiN))
+        else:
+            print('aSCNA based TiN estimate: TiN =  ' + str(self.TiN))
+
+    def select_cluster(self):
+        # TiN likelihood of the reported cluster of segments
+        self.cluster_TiN_likelihoods = []
+        if np.max(self.cluster_assignment) > 0:
             self.cluster_TiN_likelihoods = [
                 np.sum(self.TiN_likelihood_matrix[self.cluster_assignment == mode_cluster, :], axis=0) for mode_cluster
                 in range(len(self.centroids))]
@@ -167,31 +252,31 @@ class model:
                 mode_cluster = mode(self.cluster_assignment)[0][0]
             elif self.reporting_cluster == 'min':
                 mode_cluster = self.cluster_assignment[np.argmin(self.centroids)]
-
-            self.TiN = self.TiN_range[
-                np.nanargmax(np.sum(self.TiN_likelihood_matrix[self.cluster_assignment == mode_cluster, :], axis=0))]
             self.TiN_likelihood = np.sum(self.TiN_likelihood_matrix[self.cluster_assignment == mode_cluster, :], axis=0)
-
-            posterior = np.exp(self.TiN_likelihood - np.nanmax(self.TiN_likelihood))
-            self.CI_tin_low = self.TiN_range[
-                next(x[0] for x in
-                     enumerate(np.cumsum(np.ma.masked_array(np.true_divide(posterior, np.nansum(posterior)))))
-                     if x[1] > 0.025)]
-            self.CI_tin_high = self.TiN_range[
-                next(x[0] for x in
-                     enumerate(np.cumsum(np.ma.masked_array(np.true_divide(posterior, np.nansum(posterior)))))
-                     if x[1] > 0.975)]
-            print('aSCNA based TiN estimate from selected TiN cluster :  ' + str(self.TiN))
         else:
-            self.TiN = self.TiN_range[np.nanargmax(np.sum(self.TiN_likelihood_matrix, axis=0))]
             self.TiN_likelihood = np.sum(self.TiN_likelihood_matrix, axis=0)
-            posterior = np.exp(self.TiN_likelihood - np.nanmax(self.TiN_likelihood))
-            self.CI_tin_low = self.TiN_range[
-                next(x[0] for x in
-                     enumerate(np.cumsum(np.ma.masked_array(np.true_divide(posterior, np.nansum(posterior)))))
-                     if x[1] > 0.025)]
-            self.CI_tin_high = self.TiN_range[
-                next(x[0] for x in
-                     enumerate(np.cumsum(np.ma.masked_array(np.true_divide(posterior, np.nansum(posterior)))))
-                     if x[1] > 0.975)]
-            print('aSCNA based TiN estimate: TiN =  ' + str(self.TiN))
+
+
+def het_likelihood_task(block, inputs, outputs):
+    # log likelihood of each het relative to TiN = 0 for the TiN columns start:stop
+    # the beta binomial terms are evaluated for af_block allele fractions of the tumor at a time
+    # (allele fraction x het x TiN) and summed over the allele fractions in the same order for every block
+    start, stop = block
+    CN_ratio = inputs['CN_ratio'][:, start:stop].astype(np.float64)
+    psi_t_af = inputs['psi_t_af']
+    t_depth = inputs['t_depth']
+    zero_tin_terms = inputs['zero_tin_terms']
+    af_block = int(inputs['af_block'])
+    kernel = du.beta_binomial_kernel(inputs['n_alt_count'].reshape(-1, 1), inputs['n_depth'].reshape(-1, 1))
+    p_TiN = np.zeros(CN_ratio.shape)
+    for af_start in range(0, psi_t_af.shape[1], af_block):
+        exp_f = inputs['mu_af_n'] + np.multiply(np.expand_dims(psi_t_af[:, af_start:af_start + af_block].T, 2),
+                                                CN_ratio)
+        exp_f[exp_f < 0] = 0
+        exp_f[exp_f > 1] = 1
+        a = exp_f*t_depth
+        b = t_depth - a
+        terms = kernel.tin_terms(a + 1, b + 1)
+        for af_terms in terms:
+            p_TiN += af_terms - zero_tin_terms
+    outputs['p_TiN'][:, start:stop] = p_TiN
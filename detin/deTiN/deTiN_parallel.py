@@ -0,0 +1,112 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class executor:
+    """Runs the blocks of a TiN likelihood kernel on a pool of workers.
+     serial  : blocks run one after the other in this process
+     thread  : blocks run on a thread pool (numpy and scipy release the GIL in their loops)
+     process : blocks run on a process pool, inputs and outputs are placed in shared memory
+     The pool is started by the first run and reused by all later runs until shutdown, so one executor
+     should be shared by all the models of a deTiN run.
+     Each element of the outputs is computed by exactly the same operations whatever the backend and
+     number of workers, so the results are bit identical to the serial run."""
+
+    def __init__(self, kind='serial', threads=1):
+        self.threads = max(int(threads), 1)
+        self.kind = kind if self.threads > 1 else 'serial'
+        if self.kind not in ['serial', 'thread', 'process']:
+            raise ValueError('unknown executor ' + str(self.kind))
+        self.pool = None
+
+    def run(self, kernel, blocks, inputs, outputs):
+        # kernel(block, inputs, outputs) computes one block, reading the dict of input arrays and writing its
+        # part of the dict of output arrays. kernel has to be a module level function for the process backend
+        if self.kind == 'serial' or len(blocks) < 2:
+            for block in blocks:
+                kernel(block, inputs, outputs)
+        elif self.kind == 'thread':
+            list(self.worker_pool().map(lambda block: kernel(block, inputs, outputs), blocks))
+        else:
+            run_in_shared_memory(kernel, blocks, inputs, outputs, self.worker_pool())
+
+    def worker_pool(self):
+        if self.pool is None:
+            if self.kind == 'thread':
+                self.pool = ThreadPoolExecutor(max_workers=self.threads)
+            else:
+                self.pool = ProcessPoolExecutor(max_workers=self.threads)
+        return self.pool
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def as_executor(executor_or_kind, threads=1):
+    # the executor passed to a model, or a new executor of that kind
+    if isinstance(executor_or_kind, executor):
+        return executor_or_kind
+    return executor(executor_or_kind, threads)
+
+
+def run_in_shared_memory(kernel, blocks, inputs, outputs, pool):
+    # the inputs and outputs of each call are copied to new shared memory segments, the pool is reused
+    from multiprocessing import shared_memory
+    segments = []
+    try:
+        specs = []
+        for arrays in [inputs, outputs]:
+            spec = dict()
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                # keep the memory layout of the array, numpy picks the loop order of the kernel from it
+                order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+                segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                segments.append(segment)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf, order=order)[...] = array
+                spec[name] = (segment.name, array.shape, array.dtype.str, order)
+            specs.append(spec)
+        list(pool.map(run_shared_block, [kernel] * len(blocks), blocks, [specs[0]] * len(blocks),
+                      [specs[1]] * len(blocks)))
+        for segment, (name, output) in zip(segments[len(inputs):], outputs.items()):
+            output[...] = np.ndarray(output.shape, dtype=output.dtype, buffer=segment.buf, order=specs[1][name][3])
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+
+def run_shared_block(kernel, block, input_spec, output_spec):
+    # worker side of the process backend: map the shared arrays and run one block
+    from multiprocessing import shared_memory
+    segments = []
+    arrays = []
+    for spec in [input_spec, output_spec]:
+        views = dict()
+        for name, (segment_name, shape, dtype, order) in spec.items():
+            segment = attach_shared_memory(shared_memory, segment_name)
+            segments.append(segment)
+            views[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf, order=order)
+        arrays.append(views)
+    try:
+        kernel(block, arrays[0], arrays[1])
+    finally:
+        del arrays, views
+        for segment in segments:
+            segment.close()
+
+
+def attach_shared_memory(shared_memory, name):
+    # workers share the resource tracker of the creating process, which unlinks the segments
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def column_blocks(n_columns, block_size):
+    # (start, stop) column ranges of at most block_size columns
+    block_size = max(block_size, 1)
+    return [(start, min(start + block_size, n_columns)) for start in range(0, n_columns, block_size)]
@@ -1,18 +1,18 @@
 import numpy as np
 import sys
-from scipy.stats import beta
-from scipy.stats import fisher_exact
+from scipy.stats import hypergeom
 from itertools import compress
 import gzip
-import random
+import heapq
+import io
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import os
 import pandas as pd
-import matplotlib
 import pickle
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
 from scipy.special import gammaln
 
-random.seed(1)
 
 def beta_binomial_pdf(x,n,a,b):
     x = x.reshape(-1,1)
@@ -20,6 +20,105 @@ def beta_binomial_pdf(x,n,a,b):
     return gammaln(n+1) + gammaln(x+a) + gammaln(n-x+b) + gammaln(a+b) - \
         (gammaln(x+1) + gammaln(n-x+1) + gammaln(a) + gammaln(b) + gammaln(n+a+b))
 
+class beta_binomial_kernel:
+    """Log beta binomial pdf of fixed counts x out of n evaluated for many (a, b) grid points.
+       The terms which only depend on the counts are computed once when the kernel is built,
+       x and n are used with the shape they are given in (e.g. one row per het) and broadcast against a and b"""
+
+    def __init__(self, x, n):
+        self.x = x
+        self.n = n
+        self.n_minus_x = n - x
+        self.count_terms = gammaln(n + 1)
+        self.gammaln_x = gammaln(x + 1)
+        self.gammaln_n_minus_x = gammaln(self.n_minus_x + 1)
+
+    def tin_terms(self, a, b):
+        # terms of the log pdf which change with a for a fixed a + b
+        return gammaln(self.x + a) + gammaln(self.n_minus_x + b) - (gammaln(a) + gammaln(b))
+
+    def logpdf(self, a, b):
+        return self.count_terms + gammaln(self.x + a) + gammaln(self.n_minus_x + b) + gammaln(a + b) - \
+            (self.gammaln_x + self.gammaln_n_minus_x + gammaln(a) + gammaln(b) + gammaln(self.n + a + b))
+
+
+def grid_points_per_block(cells_per_point, max_memory, n_temporaries=8, itemsize=8):
+    # number of grid points (e.g. TiN columns) that can be evaluated in one call while keeping
+    # n_temporaries arrays of cells_per_point values per grid point within max_memory GB
+    bytes_per_point = max(cells_per_point, 1) * n_temporaries * itemsize
+    return max(int(max_memory * 1024 ** 3 // bytes_per_point), 1)
+
+
+def blocked_dot(weights, matrix, block_rows=4096):
+    # weights . matrix for reduced precision matrices: each block of rows is reduced in the precision
+    # of the matrix and the partial sums are accumulated in float64
+    if matrix.dtype == np.float64:
+        return np.dot(weights, matrix)
+    total = np.zeros(matrix.shape[1])
+    for start in range(0, matrix.shape[0], block_rows):
+        total += np.dot(weights[start:start + block_rows].astype(matrix.dtype), matrix[start:start + block_rows])
+    return total
+
+
+def tolerance_report(model_name, model, reference_model):
+    # deviation of a model run in reduced precision from the same model run in float64
+    likelihood = np.ravel(model.TiN_likelihood) - np.nanmax(model.TiN_likelihood)
+    reference_likelihood = np.ravel(reference_model.TiN_likelihood) - np.nanmax(reference_model.TiN_likelihood)
+    finite = np.logical_and(np.isfinite(likelihood), np.isfinite(reference_likelihood))
+    posterior = np.exp(likelihood)
+    posterior = np.true_divide(posterior, np.nansum(posterior))
+    reference_posterior = np.exp(reference_likelihood)
+    reference_posterior = np.true_divide(reference_posterior, np.nansum(reference_posterior))
+    return {'model': model_name, 'precision': str(model.dtype),
+            'TiN': model.TiN, 'TiN_float64': reference_model.TiN,
+            'CI_tin_low': model.CI_tin_low, 'CI_tin_low_float64': reference_model.CI_tin_low,
+            'CI_tin_high': model.CI_tin_high, 'CI_tin_high_float64': reference_model.CI_tin_high,
+            'max_abs_log_likelihood_diff': np.max(np.abs(likelihood[finite] - reference_likelihood[finite]),
+                                                  initial=0),
+            'max_abs_posterior_diff': np.nanmax(np.abs(posterior - reference_posterior))}
+
+
+def coarse_tin_grid(resolution, coarse_resolution):
+    # indices of the TiN grid evaluated by the first pass of the adaptive grid search
+    return np.unique(np.round(np.linspace(0, resolution - 1, min(coarse_resolution, resolution))).astype(int))
+
+
+def interpolate_tin_likelihood(likelihood, evaluated):
+    # fill the log likelihood at TiN values which were not evaluated by linear interpolation
+    if np.all(evaluated):
+        return likelihood
+    tin_idx = np.arange(len(likelihood))
+    likelihood = np.array(likelihood, dtype=float)
+    likelihood[~evaluated] = np.interp(tin_idx[~evaluated], tin_idx[evaluated], likelihood[evaluated])
+    return likelihood
+
+
+def tin_posterior_summary(log_likelihood):
+    # normalized posterior (uniform prior), MAP index and 95% CI bound indices of each row of a
+    # (k x resolution) log likelihood matrix. A single likelihood vector is treated as one row
+    log_likelihood = np.atleast_2d(log_likelihood)
+    posterior = np.exp(log_likelihood - np.nanmax(log_likelihood, axis=1, keepdims=True))
+    posterior = np.true_divide(posterior, np.nansum(posterior, axis=1, keepdims=True))
+    cdf = np.nancumsum(posterior, axis=1)
+    tin_map = np.nanargmax(log_likelihood, axis=1)
+    ci_low = np.argmax(cdf > 0.025, axis=1)
+    ci_high = np.argmax(cdf > 0.975, axis=1)
+    return posterior, tin_map, ci_low, ci_high
+
+
+def tin_refinement_grid(likelihood, evaluated, coarse_resolution):
+    # TiN indices not evaluated yet which lie within one coarse grid step of the MAP or the 95% CI bounds
+    # likelihood can be a single likelihood vector or one likelihood per row
+    likelihood = np.atleast_2d(likelihood)
+    resolution = likelihood.shape[1]
+    step = int(np.ceil(np.true_divide(resolution - 1, max(min(coarse_resolution, resolution) - 1, 1))))
+    _, tin_map, ci_low, ci_high = tin_posterior_summary(likelihood)
+    anchors = np.concatenate([tin_map, ci_low, ci_high])
+    refine_idx = np.unique(np.concatenate([np.arange(max(a - step, 0), min(a + step + 1, resolution))
+                                           for a in anchors]))
+    return refine_idx[~evaluated[refine_idx]]
+
+
 def is_number(s):
     try:
         float(s)
@@ -38,45 +137,131 @@ def is_member(a, b):
     return [bind.get(itm, np.nan) for itm in a]
 
 
-def chr2num(chr):
-    if chr[0][0:2] == 'ch':
-        chr = [c[3:] for c in chr]
+# chromosome lengths of the supported builds in chromosome code order 1-22, X, Y, M
+genome_builds = {'hg19': [249250621, 243199373, 198022430, 191154276, 180915260, 171115067, 159138663,
+                          146364022, 141213431, 135534747, 135006516, 133851895, 115169878, 107349540,
+                          102531392, 90354753, 81195210, 78077248, 59128983, 63025520, 48129895, 51304566,
+                          155270560, 59373566, 16569],  # chromosome lengths from genome-mysql.cse.ucsc.edu
+                 'GRCh38': [248956422, 242193529, 198295559, 190214555, 181538259, 170805979, 159345973,
+                            145138636, 138394717, 133797422, 135086622, 133275309, 114364328, 107043718,
+                            101991189, 90338345, 83257441, 80373285, 58617616, 64444167, 46709983, 50818468,
+                            156040895, 57227415, 16569]}
+genome_builds['hg38'] = genome_builds['GRCh38']
+
+# centromere boundary positions of each chromosome in chromosome code order (hg19: UCSC gap table,
+# GRCh38: acen bands of the UCSC cytoBand table). Sites close to them are excluded from the aSCNA model
+genome_centromeres = {'hg19': [[125000000], [90500000, 93300000], [87900000, 91000000], [48200000, 50400000],
+                               [46100000, 48400000], [58700000, 61000000], [58000000, 59900000], [43100000, 45600000],
+                               [47300000, 49000000], [38000000, 40200000], [51600000, 53700000], [33300000, 35800000],
+                               [16300000, 17900000], [16100000, 17600000], [15800000, 19000000], [34600000, 36600000],
+                               [22200000, 24000000], [15400000, 17200000], [24400000, 26500000], [25600000, 27500000],
+                               [10900000, 13200000], [12200000, 14700000]],
+                      'GRCh38': [[121700000, 125100000], [91800000, 96000000], [87800000, 94000000],
+                                 [48200000, 51800000], [46100000, 51400000], [58500000, 62600000],
+                                 [58100000, 62100000], [43200000, 47200000], [42200000, 45500000],
+                                 [38000000, 41600000], [51000000, 55800000], [33200000, 37800000],
+                                 [16500000, 18900000], [16100000, 18200000], [17500000, 20500000],
+                                 [35300000, 38400000], [22700000, 27400000], [15400000, 21500000],
+                                 [24200000, 28100000], [25700000, 30400000], [10900000, 13000000],
+                                 [13700000, 17400000], [58100000, 61000000], [10300000, 10600000]]}
+genome_centromeres['hg38'] = genome_centromeres['GRCh38']
+
+
+class genome_index:
+    """Chromosome codes (0-24 for 1-22, X, Y, M) and linear genomic coordinates of one reference build.
+     The chromosome lengths come from a .fai or sequence dictionary (.dict) of the reference when one is given,
+     otherwise from the table of the build. Contigs outside 1-22, X, Y, M (alts, decoys ...) have no code (nan)"""
+
+    def __init__(self, build='GRCh38', reference_index='None'):
+        self.contig_names = [str(c) for c in range(1, 23)] + ['X', 'Y', 'M']
+        if build not in genome_builds:
+            raise ValueError('unknown genome build ' + str(build) + ', supported builds: ' + ', '.join(genome_builds))
+        self.build = build
+        if reference_index != 'None':
+            self.lengths = read_reference_index(reference_index, self.contig_names)
+        else:
+            self.lengths = np.array(genome_builds[build])
+        # linear coordinate of position 0 of each chromosome
+        self.offsets = np.append(1, np.cumsum(self.lengths))
+
+    def contig_code(self, contig):
+        # code of a single contig name e.g. chr1, 1, chrX, MT
+        contig = contig_name(contig)
+        if contig in self.contig_names:
+            return self.contig_names.index(contig)
+        return np.nan
+
+    def chromosome_codes(self, contigs):
+        # vectorized contig encoding: each distinct contig name is coded once
+        contigs = np.asarray(contigs)
+        if np.issubdtype(contigs.dtype, np.number):
+            return contigs - 1
+        codes, names = pd.factorize(contigs)
+        name_codes = np.append([self.contig_code(name) for name in names], np.nan)
+        return name_codes[codes]
+
+    def linear_positions(self, chromosome, position):
+        return self.offsets[np.asarray(chromosome).astype(int)] + np.asarray(position)
+
+    def centromere_and_telomere_positions(self):
+        # sorted linear coordinates of the centromere boundaries and chromosome ends
+        centromeres = genome_centromeres[self.build]
+        chromosome = np.concatenate([[c] * len(positions) for c, positions in enumerate(centromeres)])
+        centromere_positions = self.linear_positions(chromosome, np.concatenate(centromeres))
+        return np.sort(np.concatenate([centromere_positions, self.offsets]))
+
+
+def contig_name(contig):
+    # contig name without chr prefix, MT is named M
+    contig = str(contig)
+    if contig[0:3] == 'chr':
+        contig = contig[3:]
+    if contig == 'MT':
+        contig = 'M'
+    return contig
+
+
+def read_reference_index(reference_index, contig_names):
+    # chromosome lengths in contig_names order from a .fai (name, length, ...) or a sequence dictionary
+    # (@SQ SN:name LN:length) file. Chromosomes absent from the file get length 0
+    lengths = dict()
+    with open(reference_index) as f:
+        for line in f:
+            spl = line.rstrip('\n').split('\t')
+            if line[0:3] == '@SQ':
+                fields = dict(field.split(':', 1) for field in spl[1:] if ':' in field)
+                lengths[fields['SN']] = int(fields['LN'])
+            elif line[0] != '@' and len(spl) > 1:
+                lengths[spl[0]] = int(spl[1])
+    index_lengths = np.zeros(len(contig_names), dtype=int)
+    for name, length in lengths.items():
+        if contig_name(name) in contig_names:
+            index_lengths[contig_names.index(contig_name(name))] = length
+    return index_lengths
+
+
+def chr2num(chr, genome=None):
     # convert chromosome from strings to ints
-    chr = ['23' if x == 'X' else x for x in chr]
-    chr = ['24' if x == 'Y' else x for x in chr]
-    chr = ['25' if x == 'M' else x for x in chr]
-    chr = ['25' if x == 'MT' else x for x in chr]
-    chromosomes = np.array(range(1, 26))
-    return np.array(is_member(chr, chromosomes.astype(np.str)))
-
-
-def remove_sites_near_centromere_and_telomeres(het_table):
-    positions = het_table['genomic_coord_x']
-    centromere_positions = [125000001, 1718373143, 1720573143, 1867507890,
-                            1869607890, 1984214406, 1986714406, 2101066301,
-                            2102666301, 2216036179, 2217536179, 2323085719, 2326285719, 2444417111,
-                            2446417111, 2522371864, 2524171864, 2596767074, 2598567074, 2683844322,
-                            2685944322, 339750621, 342550621, 2744173305, 2746073305, 2792498825, 2794798825,
-                            2841928720,
-                            2844428720, 580349994, 583449994, 738672424, 740872424, 927726700, 930026700, 1121241960,
-                            1123541960, 1291657027, 1293557027, 1435895690, 1438395690, 1586459712, 1588159712]
-
-    lengths = np.array([249250621, 243199373, 198022430, 191154276, 180915260, 171115067, 159138663,
-                        146364022, 141213431, 135534747, 135006516, 133851895, 115169878, 107349540,
-                        102531392, 90354753, 81195210, 78077248, 59128983, 63025520, 48129895, 51304566,
-                        155270560, 59373566, 16569])  # chromosome lengths from genome-mysql.cse.ucsc.edu
-    telomere_positions = np.append(1, np.cumsum(lengths))
-    distance_centromere = np.zeros([len(positions), len(centromere_positions)])
-    distance_telomere = np.zeros([len(positions), len(telomere_positions)])
-
-    for i, centromere in enumerate(centromere_positions):
-        distance_centromere[:, i] = np.abs(positions - centromere)
-    distance_centromere = np.min(distance_centromere, axis=1)
-
-    for i, telomere in enumerate(telomere_positions):
-        distance_telomere[:, i] = np.abs(positions - telomere)
-    distance_telomere = np.min(distance_telomere, axis=1)
-    het_table = het_table[np.logical_and(distance_centromere > 5000000, distance_telomere > 5000000)]
+    if genome is None:
+        genome = genome_index()
+    chromosome = genome.chromosome_codes(chr)
+    # chromosomes are ints when every contig is known
+    if np.all(np.isfinite(chromosome)):
+        return chromosome.astype(int)
+    return chromosome
+
+
+def remove_sites_near_centromere_and_telomeres(het_table, genome=None, distance=5000000):
+    # keep hets further than distance from every centromere boundary and chromosome end of the genome
+    # the distance to the closest boundary is found by binary search in the sorted boundaries
+    if genome is None:
+        genome = genome_index()
+    positions = np.array(het_table['genomic_coord_x'], dtype=float)
+    boundaries = genome.centromere_and_telomere_positions()
+    closest = np.searchsorted(boundaries, positions)
+    distance_left = np.abs(positions - boundaries[np.maximum(closest - 1, 0)])
+    distance_right = np.abs(positions - boundaries[np.minimum(closest, len(boundaries) - 1)])
+    het_table = het_table[np.minimum(distance_left, distance_right) > distance]
     het_table.reset_index(inplace=True, drop=True)
     return het_table
 
@@ -87,6 +272,106 @@ def filter_hets_based_on_coverage(het_table, depth = 10):
     return het_table
 
 
+def read_het_file_filtered(het_file, genome=None, distance=5000000, depth=0, chunk_size=500000):
+    # chunked read of a het file keeping only the sites used by the aSCNA model: on a chromosome of the genome,
+    # further than distance from a centromere or telomere and with at least depth reads (ALT_COUNT + REF_COUNT).
+    # adds Chromosome, genomic_coord_x and AF to the kept sites
+    if genome is None:
+        genome = genome_index()
+    het_header = read_file_header(het_file)
+    columns = None
+    chunks = []
+    for chunk in pd.read_csv(het_file, sep='\t', index_col=False, comment='#', dtype={het_header[0]: str},
+                             chunksize=chunk_size):
+        if columns is None:
+            columns = fix_het_file_header(chunk).columns
+        chunk.columns = columns
+        chunk['Chromosome'] = chr2num(np.array(chunk['CONTIG']), genome)
+        chunk = chunk[np.isfinite(chunk['Chromosome'])]
+        chunk['genomic_coord_x'] = genome.linear_positions(np.array(chunk['Chromosome']), np.array(chunk['POSITION']))
+        chunk = remove_sites_near_centromere_and_telomeres(chunk, genome, distance)
+        chunk = chunk[np.array(chunk['ALT_COUNT'] + chunk['REF_COUNT'] >= depth)]
+        chunk['AF'] = np.true_divide(chunk['ALT_COUNT'], chunk['ALT_COUNT'] + chunk['REF_COUNT'])
+        chunks.append(chunk)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def sort_merge_hets(normal_het_table, tumor_het_table, key='genomic_coord_x', suffixes=('_N', '_T')):
+    # inner join of the normal and tumor hets on key, same rows and columns as pd.merge(normal, tumor, on=key).
+    # GATK writes hets sorted by position so the join is a merge of the two sorted key arrays,
+    # tables out of order are sorted first
+    tables = []
+    for table in [normal_het_table, tumor_het_table]:
+        if not table[key].is_monotonic_increasing:
+            table = table.sort_values(key, kind='mergesort')
+        tables.append(table.reset_index(drop=True))
+    normal_het_table, tumor_het_table = tables
+    normal_keys = np.array(normal_het_table[key])
+    tumor_keys = np.array(tumor_het_table[key])
+    first = np.searchsorted(tumor_keys, normal_keys, side='left')
+    matches = np.searchsorted(tumor_keys, normal_keys, side='right') - first
+    # every normal het is paired with each tumor het of the same key
+    normal_rows = np.repeat(np.arange(len(normal_keys)), matches)
+    tumor_rows = np.repeat(first - np.cumsum(matches) + matches, matches) + np.arange(len(normal_rows))
+    shared = [column for column in normal_het_table.columns if column in tumor_het_table.columns and column != key]
+    normal_part = normal_het_table.iloc[normal_rows].reset_index(drop=True)
+    tumor_part = tumor_het_table.iloc[tumor_rows].drop(columns=key).reset_index(drop=True)
+    normal_part.rename(columns={column: column + suffixes[0] for column in shared}, inplace=True)
+    tumor_part.rename(columns={column: column + suffixes[1] for column in shared}, inplace=True)
+    return pd.concat([normal_part, tumor_part], axis=1)
+
+
+class segment_index:
+    """Lookup of the segment of seg_table (genomic_coord_start to genomic_coord_end inclusive) containing
+     linear genomic coordinates. Where segments overlap the segment of the last row wins.
+     The segments are cut once into sorted elementary intervals labelled with their covering segment
+     so that each lookup is a binary search"""
+
+    def __init__(self, seg_table):
+        self.seg_table = seg_table
+        starts = np.array(seg_table['genomic_coord_start'], dtype=float)
+        ends = np.array(seg_table['genomic_coord_end'], dtype=float) + 1
+        rows = np.where(np.logical_and(np.isfinite(starts), np.isfinite(ends)))[0]
+        # interval i covers [boundaries[i], boundaries[i + 1]) and belongs to the seg_table row interval_row[i]
+        self.boundaries = np.unique(np.concatenate([starts[rows], ends[rows]]))
+        self.interval_row = np.zeros(max(len(self.boundaries) - 1, 0), dtype=int) - 1
+        # sweep over the boundaries keeping the covering segments in a heap ordered by last row first
+        starting = np.searchsorted(self.boundaries, starts[rows])
+        ending = np.searchsorted(self.boundaries, ends[rows])
+        order = np.argsort(starting, kind='mergesort')
+        active = []
+        next_segment = 0
+        for i in range(len(self.interval_row)):
+            while next_segment < len(order) and starting[order[next_segment]] <= i:
+                heapq.heappush(active, (-rows[order[next_segment]], ending[order[next_segment]]))
+                next_segment += 1
+            while len(active) > 0 and active[0][1] <= i:
+                heapq.heappop(active)
+            if len(active) > 0:
+                self.interval_row[i] = -active[0][0]
+
+    def lookup(self, positions):
+        # seg_table row position of the segment containing each position, -1 outside all segments
+        positions = np.array(positions, dtype=float)
+        interval = np.searchsorted(self.boundaries, positions, side='right') - 1
+        inside = np.logical_and(interval >= 0, interval < len(self.interval_row))
+        rows = np.zeros(len(positions), dtype=int) - 1
+        rows[inside] = self.interval_row[interval[inside]]
+        return rows
+
+    def values(self, rows, column, default):
+        # value of column for the segment rows, default outside all segments
+        values = np.zeros(len(rows)) + default
+        values[rows >= 0] = np.array(self.seg_table[column], dtype=float)[rows[rows >= 0]]
+        return values
+
+    def labels(self, rows, default=-1):
+        # index label of the segment rows, default outside all segments
+        labels = np.zeros(len(rows)) + default
+        labels[rows >= 0] = np.array(self.seg_table.index)[rows[rows >= 0]]
+        return labels
+
+
 def filter_segments_based_on_size_f_and_tau(seg_table, aSCNA_thresh, n_probes = 200):
     seg_table = seg_table[np.logical_and.reduce(np.array([np.array(seg_table['f']) < 0.5 - aSCNA_thresh,
                                                           seg_table['n_probes'] > n_probes, seg_table['tau'] > 0]))]
@@ -125,30 +410,36 @@ def read_file_header(text_file):
 def identify_aSCNAs(seg_table, het_table, aSCNA_thresh = 0.1, n_snps = 20, var_thresh = 0.025):
     # identify aSCNAs based on minor allele fraction of segments
     mu_af_n = np.mean(het_table['AF_N'])
-    f_detin = np.zeros([len(seg_table), 1])
-    f_variance = np.zeros([len(seg_table), 1])
-    n_snps_above_mu = np.zeros([len(seg_table), 1])
-    n_snps_below_mu = np.zeros([len(seg_table), 1])
-    fishers_p_convergent_seg = np.ones([len(seg_table), 1])
     thresh_snps = np.round(np.true_divide(n_snps,2))
-    for seg_id, seg in seg_table.iterrows():
-        seg_hets = het_table[het_table['seg_id'] == seg_id]
-        f_detin[seg_id] = mu_af_n - np.mean(np.abs(seg_hets['AF_T'] - mu_af_n))
-        f_variance[seg_id] = np.var(np.abs(seg_hets['AF_T'] - mu_af_n))
-        n_snps_above_mu[seg_id] = np.sum(seg_hets['AF_T'] > mu_af_n)
-        n_snps_below_mu[seg_id] = np.sum(seg_hets['AF_T'] <= mu_af_n)
-        try:
-            fe_tuple = fisher_exact([[np.sum(np.logical_and(seg_hets['AF_T'] > mu_af_n,
-                                                            seg_hets['AF_N'] > mu_af_n)),
-                                      np.sum(np.logical_and(seg_hets['AF_T'] > mu_af_n,
-                                                            seg_hets['AF_N'] <= mu_af_n))],
-                                     [np.sum(np.logical_and(seg_hets['AF_T'] <= mu_af_n,
-                                                            seg_hets['AF_N'] > mu_af_n)),
-                                      np.sum(np.logical_and(seg_hets['AF_T'] <= mu_af_n,
-                                                            seg_hets['AF_N'] <= mu_af_n))]], 'less')
-            fishers_p_convergent_seg[seg_id] = fe_tuple[1]
-        except ValueError:
-            fishers_p_convergent_seg[seg_id] = 1
+    # per segment statistics as grouped sums over the hets of each segment
+    het_seg = pd.Index(seg_table.index).get_indexer(het_table['seg_id'])
+    in_segs = het_seg >= 0
+    het_seg = het_seg[in_segs]
+    af_t = np.array(het_table['AF_T'], dtype=float)[in_segs]
+    af_n = np.array(het_table['AF_N'], dtype=float)[in_segs]
+
+    def seg_sum(weights):
+        return np.bincount(het_seg, weights=weights, minlength=len(seg_table))
+
+    n_hets = seg_sum(None)
+    distance = np.abs(af_t - mu_af_n)
+    mean_distance = np.true_divide(seg_sum(distance), n_hets)
+    f_detin = mu_af_n - mean_distance
+    f_variance = np.true_divide(seg_sum(np.power(distance - mean_distance[het_seg], 2)), n_hets)
+    t_above = af_t > mu_af_n
+    n_above = af_n > mu_af_n
+    n_snps_above_mu = seg_sum(t_above)
+    n_snps_below_mu = seg_sum(~t_above)
+    # one sided (less) Fisher exact test of [[t above & n above, t above & n below],
+    # [t below & n above, t below & n below]] for all segments at once: P(X <= table[0, 0]) for the
+    # hypergeometric X given the margins, 1 when a margin is empty as in scipy.stats.fisher_exact
+    both_above = seg_sum(np.logical_and(t_above, n_above))
+    n_above_total = seg_sum(n_above)
+    fishers_p_convergent_seg = hypergeom.cdf(both_above.astype(int), n_hets.astype(int),
+                                             n_snps_above_mu.astype(int), n_above_total.astype(int))
+    empty_margin = np.logical_or.reduce([n_snps_above_mu == 0, n_snps_below_mu == 0, n_above_total == 0,
+                                         n_above_total == n_hets])
+    fishers_p_convergent_seg[empty_margin] = 1
     seg_table['f_detin'] = f_detin
     seg_table['f_variance'] = f_variance
     seg_table['n_snps_above_mu'] = n_snps_above_mu
@@ -170,47 +461,97 @@ def identify_aSCNAs(seg_table, het_table, aSCNA_thresh = 0.1, n_snps = 20, var_t
     return aSCNAs,convergent_segs
 
 
-def ensure_balanced_hets(seg_table, het_table):
+def ensure_balanced_hets(seg_table, het_table, seed=1):
+    # keep the hets of segments with more than 10 hets on each side of 0.5 tumor allele fraction and drop
+    # randomly chosen hets from the larger side until both sides have the same number of hets
+    # hets are returned grouped by segment in seg_table order
     seg_table['aSCNA'] = np.zeros([len(seg_table), 1])
-    aSCNA_hets = []
-    for seg_id, seg in seg_table.iterrows():
-        seg_hets = het_table[het_table['seg_id'] == seg_id]
-        if np.sum(seg_hets['d'] == -1) > 10 and np.sum(seg_hets['d'] == 1) > 10:
-            if sum(seg_hets['AF_T'] > 0.5) < sum(seg_hets['AF_T'] <= 0.5):
-                sites = seg_hets['AF_T'] <= 0.5
-                index = list(compress(range(len(sites)), sites))
-                ixs = random.sample(index, (sum(seg_hets['AF_T'] <= 0.5) - sum(seg_hets['AF_T'] > 0.5)))
-                seg_hets = seg_hets.drop(seg_hets.index[ixs])
-                seg_hets.reset_index(inplace=True, drop=True)
-
-            if sum(seg_hets['AF_T'] > 0.5) > sum(seg_hets['AF_T'] <= 0.5):
-                sites = seg_hets['AF_T'] > 0.5
-                index = list(compress(range(len(sites)), sites))
-                ixs = random.sample(index, (sum(seg_hets['AF_T'] > 0.5) - sum(seg_hets['AF_T'] <= 0.5)))
-                seg_hets = seg_hets.drop(seg_hets.index[ixs])
-                seg_hets.reset_index(inplace=True, drop=True)
-            if len(aSCNA_hets) == 0:
-                aSCNA_hets = seg_hets
-            else:
-                aSCNA_hets = pd.concat([aSCNA_hets, seg_hets])
-                aSCNA_hets.reset_index(inplace=True, drop=True)
+    rng = np.random.default_rng(seed)
+    het_seg = pd.Index(seg_table.index).get_indexer(het_table['seg_id'])
+    in_segs = het_seg >= 0
+    af_t = np.array(het_table['AF_T'], dtype=float)
+    d = np.array(het_table['d'], dtype=float).reshape(-1)
+    low = np.logical_and(in_segs, af_t <= 0.5)
+    high = np.logical_and(in_segs, af_t > 0.5)
+
+    def seg_count(mask):
+        return np.bincount(het_seg[mask], minlength=len(seg_table))
+
+    n_low = seg_count(low)
+    n_high = seg_count(high)
+    balanced_segs = np.logical_and(seg_count(np.logical_and(in_segs, d == -1)) > 10,
+                                   seg_count(np.logical_and(in_segs, d == 1)) > 10)
+    keep = np.logical_and(in_segs, balanced_segs[np.maximum(het_seg, 0)])
+    # the excess hets of the larger side of each segment are the ones with the smallest random keys
+    larger_side = np.logical_or(np.logical_and(high, (n_high > n_low)[np.maximum(het_seg, 0)]),
+                                np.logical_and(low, (n_low > n_high)[np.maximum(het_seg, 0)]))
+    candidates = np.where(np.logical_and(keep, larger_side))[0]
+    random_key = rng.random(len(candidates))
+    candidates = candidates[np.lexsort((random_key, het_seg[candidates]))]
+    candidate_seg = het_seg[candidates]
+    rank = np.arange(len(candidates)) - np.searchsorted(candidate_seg, candidate_seg)
+    keep[candidates[rank < np.abs(n_high - n_low)[candidate_seg]]] = False
+    if not np.any(keep):
+        return []
+    kept = np.where(keep)[0]
+    aSCNA_hets = het_table.iloc[kept[np.argsort(het_seg[kept], kind='mergesort')]]
+    aSCNA_hets.reset_index(inplace=True, drop=True)
     return aSCNA_hets
 
 
-def plot_kmeans_info(ascna_based_model, output_path, sample_name):
-    # method for plotting clustering results of aSCNA TiN estimates
-    X = np.array(ascna_based_model.segs['TiN_MAP'])
-    X_low = np.array(ascna_based_model.segs['TiN_ci_l'])
-    X_high = np.array(ascna_based_model.segs['TiN_ci_h'])
-    Y = np.array(ascna_based_model.segs['Chromosome'])
-    kIdx = int(np.max(ascna_based_model.cluster_assignment))
+def pyplot():
+    # matplotlib is only imported when plots are drawn
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_formats(plots):
+    # file formats of the scatter plots for the --plots option, the other plots are always png
+    return {'none': [], 'png': ['png'], 'all': ['png', 'eps']}[plots]
+
+
+# scatter layers with more points than this are rasterized in vector (eps) plots
+rasterize_points = 10000
+
+
+def decimate_points(x, y, bins=(1200, 400)):
+    # indices of the first point in each occupied cell of a bins grid spanning the points. At plot resolution
+    # the dropped points would be drawn over pixels already painted so the picture is unchanged
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.where(np.logical_and(np.isfinite(x), np.isfinite(y)))[0]
+    if len(finite) == 0:
+        return finite
+    cells = np.zeros(len(finite), dtype=np.int64)
+    for values, n_bins in zip([x[finite], y[finite]], bins):
+        span = np.max(values) - np.min(values)
+        scaled = (values - np.min(values)) / span if span > 0 else np.zeros(len(values))
+        cells = cells * n_bins + np.minimum((scaled * n_bins).astype(np.int64), n_bins - 1)
+    first = np.unique(cells, return_index=True)[1]
+    return finite[np.sort(first)]
+
+
+def kmeans_info_plot(ascna_based_model, output_path, sample_name):
+    return render_kmeans_info, (output_path, sample_name, np.array(ascna_based_model.segs['TiN_MAP']),
+                                np.array(ascna_based_model.segs['TiN_ci_l']),
+                                np.array(ascna_based_model.segs['TiN_ci_h']),
+                                np.array(ascna_based_model.segs['Chromosome']),
+                                np.array(ascna_based_model.cluster_assignment),
+                                ascna_based_model.sum_squared_distance)
+
+
+def render_kmeans_info(output_path, sample_name, X, X_low, X_high, Y, cluster_assignment, sum_squared_distance):
+    plt = pyplot()
+    kIdx = int(np.max(cluster_assignment))
     K = range(1, 4)
 
     # variance explained by incorporating additional clusters
     fig = plt.figure()
     ax = fig.add_subplot(111)
-    ax.plot(K, ascna_based_model.sum_squared_distance, 'b.-')
-    ax.plot(K[kIdx], ascna_based_model.sum_squared_distance[kIdx], marker='o', markersize=12,
+    ax.plot(K, sum_squared_distance, 'b.-')
+    ax.plot(K[kIdx], sum_squared_distance[kIdx], marker='o', markersize=12,
             markeredgewidth=2, markeredgecolor='r', markerfacecolor='None')
     plt.grid(True)
     plt.xlabel('Number of clusters')
@@ -219,17 +560,21 @@ def plot_kmeans_info(ascna_based_model, output_path, sample_name):
     plt.xticks([1,2,3])
     fig.set_dpi(150)
     fig.savefig(output_path + '/' + sample_name + '_KmeansEval_plot.png', bbox_inches='tight')
+    plt.close(fig)
 
     # scatter plot of TiN estimates per segment by chromosome location and cluster
+    # the MAP can fall outside of the interpolated CI, such error bars are drawn with zero length
+    xerr_low = np.maximum(X - X_low, 0)
+    xerr_high = np.maximum(X_high - X, 0)
     fig = plt.figure()
     ax = fig.add_subplot(111)
     clr = ['b', 'g', 'r']
     if len(X) > 1:
         for i in range(K[kIdx]):
-            ind = (ascna_based_model.cluster_assignment == i)
-            ax.errorbar(X[ind], Y[ind], xerr=[X[ind]-X_low[ind],X_high[ind]-X[ind]] , c=clr[i], label='Cluster %d' % i,ls='None',marker='.')
+            ind = (cluster_assignment == i)
+            ax.errorbar(X[ind], Y[ind], xerr=[xerr_low[ind],xerr_high[ind]] , c=clr[i], label='Cluster %d' % i,ls='None',marker='.')
     else:
-        ax.errorbar(X,Y+1,xerr=[X-X_low,X_high-X],c='b',label='Cluster 1',ls='None',marker='.')
+        ax.errorbar(X,Y+1,xerr=[xerr_low,xerr_high],c='b',label='Cluster 1',ls='None',marker='.')
 
     plt.xlabel('MAP tumor in normal estimate (%)')
     plt.ylabel('Chromosome')
@@ -240,17 +585,41 @@ def plot_kmeans_info(ascna_based_model, output_path, sample_name):
 
     fig.set_dpi(150)
     fig.savefig(output_path + '/' + sample_name + '_KmeansEval_scatter_plot.png', bbox_inches='tight')
+    plt.close(fig)
+
 
-def plot_aSCNA_het_data(do):
+def plot_kmeans_info(ascna_based_model, output_path, sample_name):
+    # method for plotting clustering results of aSCNA TiN estimates
+    render, args = kmeans_info_plot(ascna_based_model, output_path, sample_name)
+    render(*args)
+
+
+def aSCNA_het_data_plot(do, formats=('png', 'eps')):
+    # all hets are drawn decimated, WGS het tables have millions of sites
+    het_x = np.array(do.input.het_table['genomic_coord_x'], dtype=float)
+    het_af = np.array(do.input.het_table['AF_T'], dtype=float)
+    shown = decimate_points(het_x, het_af)
+    ascna_x = np.array(do.ascna_based_model.hets['genomic_coord_x'], dtype=float)
+    ascna_af_t = np.array(do.ascna_based_model.hets['AF_T'], dtype=float)
+    ascna_af_n = np.array(do.ascna_based_model.hets['AF_N'], dtype=float)
+    shown_t = decimate_points(ascna_x, ascna_af_t)
+    shown_n = decimate_points(ascna_x, ascna_af_n)
+    chrs = do.input.genome.linear_positions(np.linspace(0, 23, 24), np.ones([24]))
+    return render_aSCNA_het_data, (do.input.output_path + '/' + do.input.output_name + '_TiN_hets_aSCNA_model',
+                                   list(formats), het_x[shown], het_af[shown], ascna_x[shown_t], ascna_af_t[shown_t],
+                                   ascna_x[shown_n], ascna_af_n[shown_n], chrs)
+
+
+def render_aSCNA_het_data(file_prefix, formats, het_x, het_af, tumor_x, tumor_af, normal_x, normal_af, chrs):
+    plt = pyplot()
     fig, ax = plt.subplots(1, 1)
-    ax.plot(do.input.het_table['genomic_coord_x'], do.input.het_table['AF_T'], c=[0.5, 0.5, 0.5], marker='.', ls='None',
-            ms=1, alpha=0.5)
-    tumor_af = ax.plot(do.ascna_based_model.hets['genomic_coord_x'], do.ascna_based_model.hets['AF_T'], c=[0, 0, 1], marker='.',
-            ls='None', ms=5)
-    normal_af = ax.plot(do.ascna_based_model.hets['genomic_coord_x'], do.ascna_based_model.hets['AF_N'], c=[1, 0, 0], marker='.',
-            ls='None', ms=5)
+    ax.plot(het_x, het_af, c=[0.5, 0.5, 0.5], marker='.', ls='None', ms=1, alpha=0.5,
+            rasterized=len(het_x) > rasterize_points)
+    tumor_af = ax.plot(tumor_x, tumor_af, c=[0, 0, 1], marker='.', ls='None', ms=5,
+                       rasterized=len(tumor_x) > rasterize_points)
+    normal_af = ax.plot(normal_x, normal_af, c=[1, 0, 0], marker='.', ls='None', ms=5,
+                        rasterized=len(normal_x) > rasterize_points)
     fig.set_dpi(300)
-    chrs = hg19_to_linear_positions(np.linspace(0, 23, 24), np.ones([24]))
     for c in chrs:
         ax.plot([c, c], [0, 1], 'k--')
     plt.legend(handles=[tumor_af[0], normal_af[0]],labels=['Tumor', 'Normal'])
@@ -261,56 +630,85 @@ def plot_aSCNA_het_data(do):
     ax.set_xlabel('Chromosomes')
     ax.set_ylabel('Allele fraction')
     fig.set_dpi(150)
-    fig.savefig(do.input.output_path + '/' + do.input.output_name + '_TiN_hets_aSCNA_model.png', bbox_inches='tight')
-    fig.savefig(do.input.output_path + '/' + do.input.output_name + '_TiN_hets_aSCNA_model.eps', bbox_inches='tight')
+    for file_format in formats:
+        fig.savefig(file_prefix + '.' + file_format, bbox_inches='tight')
+    plt.close(fig)
 
-def plot_TiN_models(do):
-    fig, ax = plt.subplots(1, 1)
+
+def plot_aSCNA_het_data(do, formats=('png', 'eps')):
+    render, args = aSCNA_het_data_plot(do, formats)
+    render(*args)
+
+
+def TiN_models_plot(do):
     TiN_range = np.linspace(0, 1, num=do.input.resolution)
+    ascna_posterior = None
     if ~np.isnan(do.ascna_based_model.TiN):
-        ascna = ax.plot(TiN_range,
-                        np.true_divide(np.exp(
-                            do.ascna_based_model.TiN_likelihood - np.nanmax(do.ascna_based_model.TiN_likelihood)),
-                                       np.nansum(np.exp(do.ascna_based_model.TiN_likelihood - np.nanmax(
-                                           do.ascna_based_model.TiN_likelihood))))
-                        , 'r--', lw=1)
-    ssnv = ax.plot(TiN_range,
-                   np.true_divide(
-                       np.exp(do.ssnv_based_model.TiN_likelihood - np.nanmax(do.ssnv_based_model.TiN_likelihood)),
-                       np.nansum(
-                           np.exp(do.ssnv_based_model.TiN_likelihood - np.nanmax(do.ssnv_based_model.TiN_likelihood))))
-                   , 'b--', lw=1)
-
-    joint = ax.plot(TiN_range, do.joint_posterior
+        ascna_posterior = np.true_divide(np.exp(
+            do.ascna_based_model.TiN_likelihood - np.nanmax(do.ascna_based_model.TiN_likelihood)),
+            np.nansum(np.exp(do.ascna_based_model.TiN_likelihood - np.nanmax(do.ascna_based_model.TiN_likelihood))))
+    ssnv_posterior = np.true_divide(
+        np.exp(do.ssnv_based_model.TiN_likelihood - np.nanmax(do.ssnv_based_model.TiN_likelihood)),
+        np.nansum(np.exp(do.ssnv_based_model.TiN_likelihood - np.nanmax(do.ssnv_based_model.TiN_likelihood))))
+    return render_TiN_models, (do.input.output_path + '/' + do.input.output_name + '_TiN_models_plot.png', TiN_range,
+                               ascna_posterior, ssnv_posterior, np.array(do.joint_posterior))
+
+
+def render_TiN_models(file_name, TiN_range, ascna_posterior, ssnv_posterior, joint_posterior):
+    plt = pyplot()
+    fig, ax = plt.subplots(1, 1)
+    if ascna_posterior is not None:
+        ascna = ax.plot(TiN_range, ascna_posterior, 'r--', lw=1)
+    ssnv = ax.plot(TiN_range, ssnv_posterior, 'b--', lw=1)
+
+    joint = ax.plot(TiN_range, joint_posterior
                     , 'k-', lw=2)
     plt.xlabel('Tumor in normal estimate')
     plt.ylabel('p(TiN=x)')
     plt.title('TiN estimate posterior')
-    if ~np.isnan(do.ascna_based_model.TiN):
+    if ascna_posterior is not None:
         plt.legend(handles=[ascna[0], ssnv[0], joint[0]], labels=['aSCNA', 'SSNV', 'Joint Est.'])
     else:
         plt.legend(handles=[ssnv[0], joint[0]], labels=['SSNV', 'Joint Est.'])
     fig.set_dpi(150)
-    fig.savefig(do.input.output_path + '/' + do.input.output_name + '_TiN_models_plot.png', bbox_inches='tight')
+    fig.savefig(file_name, bbox_inches='tight')
+    plt.close(fig)
 
 
-def plot_SSNVs(do):
-    fig, ax = plt.subplots(1, 1)
-    TiN_fit = ax.plot(np.linspace(0, 1, do.input.resolution), np.multiply(do.TiN, np.linspace(0, 1, do.input.resolution)), '--', lw=1, alpha=1,
-                      color='#1D1D1D')
-    background = ax.plot(do.ssnv_based_model.tumor_f, do.ssnv_based_model.normal_f
-                         , '.', lw=0.1, alpha=0.75, color=[0.75, 0.75, 0.75])
+def plot_TiN_models(do):
+    render, args = TiN_models_plot(do)
+    render(*args)
+
+
+def SSNVs_plot(do, formats=('png', 'eps')):
+    tumor_f = np.array(do.ssnv_based_model.tumor_f, dtype=float).reshape(-1)
+    normal_f = np.array(do.ssnv_based_model.normal_f, dtype=float).reshape(-1)
     nod_kept = np.logical_and(do.SSNVs['judgement'] == 'KEEP', do.SSNVs.isnull()['failure_reasons']).values
+    d_kept = np.logical_and(do.SSNVs['judgement'] == 'KEEP', ~do.SSNVs.isnull()['failure_reasons']).values
     cis = do.ssnv_based_model.rv_normal_af.interval(0.6825)
+    background = decimate_points(tumor_f, normal_f)
+    return render_SSNVs, (do.input.output_path + '/' + do.input.output_name + '_SSNVs_plot', list(formats),
+                          do.input.resolution, do.TiN, tumor_f[background], normal_f[background],
+                          tumor_f[nod_kept], normal_f[nod_kept], tumor_f[d_kept], normal_f[d_kept],
+                          np.array(cis[0]).reshape(-1)[d_kept], np.array(cis[1]).reshape(-1)[d_kept])
+
 
-    kept_def = ax.plot(do.ssnv_based_model.tumor_f[nod_kept], do.ssnv_based_model.normal_f[nod_kept],
+def render_SSNVs(file_prefix, formats, resolution, TiN, tumor_f, normal_f, kept_tumor_f, kept_normal_f,
+                 recovered_tumor_f, recovered_normal_f, ci_low, ci_high):
+    plt = pyplot()
+    fig, ax = plt.subplots(1, 1)
+    TiN_fit = ax.plot(np.linspace(0, 1, resolution), np.multiply(TiN, np.linspace(0, 1, resolution)), '--', lw=1, alpha=1,
+                      color='#1D1D1D')
+    background = ax.plot(tumor_f, normal_f
+                         , '.', lw=0.1, alpha=0.75, color=[0.75, 0.75, 0.75],
+                         rasterized=len(tumor_f) > rasterize_points)
+
+    kept_def = ax.plot(kept_tumor_f, kept_normal_f,
                        'b.', lw=0.1)
-    d_kept = np.logical_and(do.SSNVs['judgement'] == 'KEEP', ~do.SSNVs.isnull()['failure_reasons']).values
-    yerr_low = do.ssnv_based_model.normal_f[d_kept] - cis[0][d_kept]
-    yerr_low[yerr_low<0] = 0
-    detin_kept = ax.errorbar(do.ssnv_based_model.tumor_f[d_kept], do.ssnv_based_model.normal_f[d_kept],
-                             yerr=[yerr_low,
-                                   cis[1][d_kept] - do.ssnv_based_model.normal_f[d_kept]], fmt='r.', capsize=2)
+    yerr_low = np.maximum(recovered_normal_f - ci_low, 0)
+    yerr_high = np.maximum(ci_high - recovered_normal_f, 0)
+    detin_kept = ax.errorbar(recovered_tumor_f, recovered_normal_f,
+                             yerr=[yerr_low, yerr_high], fmt='r.', capsize=2)
 
     plt.xlabel('Tumor AF')
     plt.ylabel('Normal AF')
@@ -318,22 +716,74 @@ def plot_SSNVs(do):
     plt.legend(handles=[background[0], kept_def[0], detin_kept[0], TiN_fit[0]],
                labels=['Candidate Sites', 'Called w/o deTiN ', 'deTiN recovered', 'TiN_fit'])
     fig.set_dpi(300)
-    fig.savefig(do.input.output_path + '/' + do.input.output_name + '_SSNVs_plot.png', bbox_inches='tight')
-    fig.savefig(do.input.output_path + '/' + do.input.output_name + '_SSNVs_plot.eps', format='eps',
-                bbox_inches='tight')
-
-
-def select_candidate_mutations(call_stats_table, exac_db_file):
-    # filter sites in call stats table to those only rejected for presence in the normal
+    for file_format in formats:
+        fig.savefig(file_prefix + '.' + file_format, format=file_format, bbox_inches='tight')
+    plt.close(fig)
+
+
+def plot_SSNVs(do, formats=('png', 'eps')):
+    render, args = SSNVs_plot(do, formats)
+    render(*args)
+
+
+def start_plots(do, plots='all', pool=None):
+    # submits the plots of the results to pool and returns their futures, so that they render while the
+    # results are written. Only plain arrays are sent to the workers. Without a pool the plots are drawn here
+    formats = plot_formats(plots)
+    if len(formats) == 0:
+        return []
+    jobs = []
+    if not np.isnan(do.ascna_based_model.TiN):
+        jobs.append(kmeans_info_plot(do.ascna_based_model, do.input.output_path, do.input.output_name))
+        jobs.append(TiN_models_plot(do))
+        jobs.append(aSCNA_het_data_plot(do, formats))
+    if not np.isnan(do.ssnv_based_model.TiN):
+        jobs.append(SSNVs_plot(do, formats))
+    if pool is None:
+        for render, args in jobs:
+            render(*args)
+        return []
+    return [pool.submit(render, *args) for render, args in jobs]
+
+
+def candidate_mutation_rows(call_stats_table):
+    # sites kept by MuTect or only rejected for presence in the normal
     failure_reasons = np.array(call_stats_table['failure_reasons'])
-
-    candidate_sites = call_stats_table[np.logical_or.reduce(np.array([np.array(call_stats_table['judgement']) == 'KEEP',
-                                                                      failure_reasons == 'normal_lod,alt_allele_in_normal',
-                                                                      failure_reasons == 'alt_allele_in_normal']))]
+    return np.logical_or.reduce(np.array([np.array(call_stats_table['judgement']) == 'KEEP',
+                                          failure_reasons == 'normal_lod,alt_allele_in_normal',
+                                          failure_reasons == 'alt_allele_in_normal']))
+
+
+def read_call_stats_candidates(call_stats_file, fields, fields_type, optional_fields=(), chunk_size=500000):
+    # single pass over a MuTect call stats file keeping only the candidate mutations, so that memory grows with
+    # the number of candidates rather than the number of evaluated sites. The header is the first line holding
+    # all the required fields, anything before it is skipped. returns the candidates and the number of sites read
+    with (gzip.open(call_stats_file, 'rt') if call_stats_file[-2:] == 'gz' else open(call_stats_file)) as f:
+        for line in f:
+            header = line.rstrip('\n').split('\t')
+            if set(fields).issubset(header):
+                break
+        else:
+            sys.exit('could not find the call stats header in ' + call_stats_file)
+        usecols = [field for field in header if field in fields or field in optional_fields]
+        chunks = []
+        n_sites = 0
+        for chunk in pd.read_csv(f, sep='\t', header=None, names=header, index_col=False, comment='#',
+                                 usecols=usecols, dtype=fields_type, chunksize=chunk_size):
+            n_sites += len(chunk)
+            chunks.append(chunk[candidate_mutation_rows(chunk)])
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=usecols), n_sites
+    return pd.concat(chunks, ignore_index=True), n_sites
+
+
+def select_candidate_mutations(call_stats_table, exac_db_file, cache_dir=None):
+    # filter sites in call stats table to those only rejected for presence in the normal
+    candidate_sites = call_stats_table[candidate_mutation_rows(call_stats_table)]
     candidate_sites['t_depth'] = candidate_sites['t_alt_count'] + candidate_sites['t_ref_count']
     candidate_sites['n_depth'] = candidate_sites['n_alt_count'] + candidate_sites['n_ref_count']
     candidate_sites.reset_index(inplace=True, drop=True)
-    candidate_sites = remove_exac_sites_from_call_stats(candidate_sites, exac_db_file)
+    candidate_sites = remove_exac_sites_from_call_stats(candidate_sites, exac_db_file, cache_dir)
 
     candidate_sites.reset_index(inplace=True, drop=True)
     return candidate_sites
@@ -348,20 +798,7 @@ def hg19_to_linear_positions(chromosome, position, **keyword_parameters):
         build = keyword_parameters['build']
     else:
         build = 'hg19'
-    if build == 'hg19':
-        L = np.array([249250621, 243199373, 198022430, 191154276, 180915260, 171115067, 159138663,
-                      146364022, 141213431, 135534747, 135006516, 133851895, 115169878, 107349540,
-                      102531392, 90354753, 81195210, 78077248, 59128983, 63025520, 48129895, 51304566,
-                      155270560, 59373566, 16569])  # chromosome lengths from genome-mysql.cse.ucsc.edu
-    if build == 'hg38':
-        L = np.array([248956422,242193529,198295559,190214555,181538259,170805979,159345973,
-                      145138636,138394717,133797422,135086622,133275309,114364328,107043718,
-                      101991189,90338345,83257441,80373285,58617616,64444167,46709983,50818468,
-                      156040895,57227415,16569])
-
-    C = np.append(1, np.cumsum(L))
-    x = np.array([chromosome[int(i)] for i in np.arange(0, len(position))],dtype=int)
-    return C[x] + position
+    return genome_index(build).linear_positions(chromosome, position)
 
 
 def fix_het_file_header(het_file):
@@ -503,116 +940,91 @@ def fix_seg_file_header(seg_file):
         return seg_file
 
 
-def read_indel_vcf(vcf,seg_table,indel_type):
-
-    content = []
-    if vcf[-2:] == 'gz':
-        with gzip.open(vcf, 'r') as f:
-            content = f.readlines()
-    else:
-        with open(vcf) as f:
-            content = f.readlines()
-
-    cols_type = {0: str}
-    for line in content:
-        if line[0] == '#' and line[1] != '#':
-            headerline = line.split('\t')
-            break
-
-    if indel_type.lower() == 'strelka':
-        indel_table = pd.read_csv(vcf, sep='\t', comment='#', header=None, low_memory=False, dtype=cols_type)
-        indel_table.rename(columns={0: 'contig', 1: 'position',2:'ID',3:'REF',4:'ALT',5:'QUAL',7:'INFO', 8: 'format', 6: 'filter', 9: headerline[9].lower(), 10: headerline[10][0:-1].lower()},
-                       inplace=True)
-        counts_format = indel_table['format'][0].split(':')
-        depth_ix = counts_format.index('DP')
-        alt_indel_ix = counts_format.index('TIR')
-        ref_indel_ix = counts_format.index('TAR')
-        indel_table = indel_table[np.isfinite(is_member(indel_table['filter'], ['PASS', 'QSI_ref']))]
-        indel_table.reset_index(inplace=True, drop=True)
-
-    elif indel_type.lower() == 'mutect2':
-        indel_table = pd.read_csv(vcf, sep='\t', comment='#', header=None, low_memory=False, dtype=cols_type)
-        # CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	TUMOR	NORMAL
-        normal_sample = 'normal'
-        tumor_sample = 'tumor'
-        for line in content:
+# FILTER values of the candidate indels of each caller
+indel_filters = {'strelka': ['PASS', 'QSI_ref'],
+                 'mutect2': ['PASS', 'alt_allele_in_normal', 'artifact_in_normal'],
+                 'sanger': ['PASS', 'F012', 'F012;F015', 'F015']}
+
+
+def vcf_sample_field(samples, formats, field, item=0):
+    # numeric value of a FORMAT field (item-th comma separated value) of each sample column entry
+    # split once per distinct FORMAT string
+    values = np.zeros(len(samples))
+    samples = samples.reset_index(drop=True)
+    formats = formats.reset_index(drop=True)
+    for format_string in formats.unique():
+        rows = np.array(formats == format_string)
+        field_ix = format_string.split(':').index(field)
+        field_values = samples[rows].str.split(':').str[field_ix]
+        values[rows] = field_values.str.split(',').str[item].astype(float)
+    return values
+
+
+def read_indel_vcf(vcf,seg_table,indel_type,genome=None,chunk_size=100000):
+    # single streaming pass over the VCF: the header is read line by line and the records in chunks of
+    # chunk_size lines of which only the candidate FILTER values are kept
+    if genome is None:
+        genome = genome_index()
+    indel_type = indel_type.lower()
+    if indel_type not in indel_filters:
+        raise ValueError('unsupported indel caller ' + indel_type + ', supported callers: Strelka, MuTect2, Sanger')
+    normal_sample = 'normal'
+    tumor_sample = 'tumor'
+    with (gzip.open(vcf, 'rt') if vcf[-2:] == 'gz' else open(vcf)) as f:
+        line = f.readline()
+        while line[0:2] == '##':
             if line[0:15] == '##normal_sample':
-                normal_sample = line.split('=')[1][0:-1]
+                normal_sample = line.rstrip('\n').split('=')[1]
             if line[0:14] == '##tumor_sample':
-                tumor_sample = line.split('=')[1][0:-1]
-        if tumor_sample == 'tumor' and normal_sample == 'normal':
-            indel_table.rename(
-                columns={0: 'contig', 1: 'position', 2: 'ID', 3: 'REF', 4: 'ALT', 5: 'QUAL', 7: 'INFO', 8: 'format',
-                         6: 'filter', 9: 'tumor', 10: 'normal'},
-                inplace=True)
+                tumor_sample = line.rstrip('\n').split('=')[1]
+            line = f.readline()
+        headerline = line.rstrip('\n').split('\t')
+        chunks = [chunk[chunk[6].isin(indel_filters[indel_type])] for chunk in
+                  pd.read_csv(f, sep='\t', header=None, low_memory=False, dtype={0: str}, chunksize=chunk_size)]
+    indel_table = pd.concat(chunks, ignore_index=True) if len(chunks) > 0 else pd.DataFrame(columns=range(11))
+
+    columns = {0: 'contig', 1: 'position', 2: 'ID', 3: 'REF', 4: 'ALT', 5: 'QUAL', 6: 'filter', 7: 'INFO', 8: 'format'}
+    if indel_type == 'mutect2':
+        # CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	TUMOR	NORMAL
+        if (tumor_sample == 'tumor' and normal_sample == 'normal') or tumor_sample == headerline[9]:
+            columns.update({9: 'tumor', 10: 'normal'})
+        elif tumor_sample == headerline[10]:
+            columns.update({9: 'normal', 10: 'tumor'})
         else:
-            if tumor_sample == headerline[9]:
-                indel_table.rename(
-                        columns={0: 'contig', 1: 'position', 2: 'ID', 3: 'REF', 4: 'ALT', 5: 'QUAL', 7: 'INFO', 8: 'format',
-                         6: 'filter', 9: 'tumor', 10: 'normal'},
-                        inplace=True)
-            elif tumor_sample == headerline[10][0:-1]:
-                indel_table.rename(
-                    columns={0: 'contig', 1: 'position', 2: 'ID', 3: 'REF', 4: 'ALT', 5: 'QUAL', 7: 'INFO', 8: 'format',
-                             6: 'filter', 9: 'normal', 10: 'tumor'},
-                    inplace=True)
-            else:
-                print('failed to read MuTect 2 indels VCF')
-                sys.exit()
-        counts_format = indel_table['format'][0].split(':')
-        depth_ix = counts_format.index('AD')
-        indel_table = indel_table[np.isfinite(is_member(indel_table['filter'], ['PASS', 'alt_allele_in_normal','artifact_in_normal']))]
-        indel_table.reset_index(inplace=True, drop=True)
-
-    elif indel_type.lower() == 'sanger':
-        indel_table = pd.read_csv(vcf, sep='\t', comment='#', header=None, low_memory=False, dtype=cols_type)
-        # CHROM  POS     ID      REF     ALT     QUAL    FILTER  INFO    FORMAT  NORMAL  TUMOUR
-        indel_table.rename(columns={0: 'contig', 1: 'position',2:'ID',3:'REF',4:'ALT',5:'QUAL',7:'INFO',8: 'format', 6: 'filter', 9: headerline[9].lower(), 10: headerline[10][0:-1].lower()},
-                           inplace=True)
-        b1 = np.logical_or.reduce([indel_table['filter'] == 'F012', indel_table['filter'] == 'F012;F015'])
-        b2 = np.logical_or.reduce([indel_table['filter'] == 'PASS', indel_table['filter'] == 'F015'])
-        indel_table = indel_table[np.logical_or.reduce([b1, b2])]
-        indel_table.reset_index(inplace=True,drop=True)
-        format_string = indel_table['format'][0].split(':')
-        total_depth_idx = [format_string.index('PR'), format_string.index('NR')]
-        alt_count_idx = [format_string.index('PU'), format_string.index('NU')]
+            print('failed to read MuTect 2 indels VCF')
+            sys.exit()
+    else:
+        # Strelka: CHROM POS ID REF ALT QUAL FILTER INFO FORMAT NORMAL TUMOR
+        # Sanger: CHROM  POS     ID      REF     ALT     QUAL    FILTER  INFO    FORMAT  NORMAL  TUMOUR
+        # the samples are taken by position since the header names differ between callers
+        columns.update({9: 'normal', 10: 'tumor'})
+    indel_table.rename(columns=columns, inplace=True)
 
     # parsing format line and file to determine required alt and ref columns
     # we use "tier 1" read counts for varaints
-    n_depth = np.zeros([len(indel_table), 1])
-    n_alt_count = np.zeros([len(indel_table), 1])
-    n_ref_count = np.zeros([len(indel_table), 1])
-
-    t_depth = np.zeros([len(indel_table), 1])
-    t_alt_count = np.zeros([len(indel_table), 1])
-    t_ref_count = np.zeros([len(indel_table), 1])
-
-    for index, row in indel_table.iterrows():
-        spl_n = row['normal'].split(':')
-        spl_t = row['tumor'].split(':')
-        if indel_type.lower() == 'strelka':
-            n_depth[index] = int(spl_n[depth_ix])
-            n_alt_count[index] = int(spl_n[alt_indel_ix].split(',')[0])
-            n_ref_count[index] = int(spl_n[ref_indel_ix].split(',')[0])
-            t_depth[index] = int(spl_t[depth_ix])
-            t_alt_count[index] = int(spl_t[alt_indel_ix].split(',')[0])
-            t_ref_count[index] = int(spl_t[ref_indel_ix].split(',')[0])
-        if indel_type.lower() == 'mutect2':
-            n_alt_count[index] = int(spl_n[depth_ix].split(',')[1])
-            n_ref_count[index] = int(spl_n[depth_ix].split(',')[0])
-            n_depth[index] = n_alt_count[index]+n_ref_count[index]
-            t_alt_count[index] = int(spl_t[depth_ix].split(',')[1])
-            t_ref_count[index] = int(spl_t[depth_ix].split(',')[0])
-            t_depth[index] = t_alt_count[index] + t_ref_count[index]
-        if indel_type.lower() == 'sanger':
-            n_depth[index] = np.sum([int(spl_n[i]) for i in total_depth_idx])
-            n_alt_count[index] = np.sum([int(spl_n[i]) for i in alt_count_idx])
-            n_ref_count[index] = n_depth[index] - n_alt_count[index]
-            t_depth[index] = np.sum([int(spl_t[i]) for i in total_depth_idx])
-            t_alt_count[index] = np.sum([int(spl_t[i]) for i in alt_count_idx])
-            t_ref_count[index] = t_depth[index] - t_alt_count[index]
+    if len(indel_table) > 0:
+        formats = indel_table['format']
+        if indel_type == 'strelka':
+            n_alt_count = vcf_sample_field(indel_table['normal'], formats, 'TIR')
+            n_ref_count = vcf_sample_field(indel_table['normal'], formats, 'TAR')
+            t_alt_count = vcf_sample_field(indel_table['tumor'], formats, 'TIR')
+            t_ref_count = vcf_sample_field(indel_table['tumor'], formats, 'TAR')
+        elif indel_type == 'mutect2':
+            n_alt_count = vcf_sample_field(indel_table['normal'], formats, 'AD', 1)
+            n_ref_count = vcf_sample_field(indel_table['normal'], formats, 'AD', 0)
+            t_alt_count = vcf_sample_field(indel_table['tumor'], formats, 'AD', 1)
+            t_ref_count = vcf_sample_field(indel_table['tumor'], formats, 'AD', 0)
+        elif indel_type == 'sanger':
+            n_alt_count = vcf_sample_field(indel_table['normal'], formats, 'PU') + \
+                vcf_sample_field(indel_table['normal'], formats, 'NU')
+            n_ref_count = vcf_sample_field(indel_table['normal'], formats, 'PR') + \
+                vcf_sample_field(indel_table['normal'], formats, 'NR') - n_alt_count
+            t_alt_count = vcf_sample_field(indel_table['tumor'], formats, 'PU') + \
+                vcf_sample_field(indel_table['tumor'], formats, 'NU')
+            t_ref_count = vcf_sample_field(indel_table['tumor'], formats, 'PR') + \
+                vcf_sample_field(indel_table['tumor'], formats, 'NR') - t_alt_count
     if len(indel_table) == 0:
-        indel_table = pd.DataFrame(index=[0],columns=['contig', 'position','ID','REF','ALT','QUAL','INFO','format', 'filter',headerline[9].lower(), headerline[10][0:-1].lower(),
+        indel_table = pd.DataFrame(index=[0],columns=['contig', 'position','ID','REF','ALT','QUAL','INFO','format', 'filter','normal', 'tumor',
                                                       't_depth','t_alt_count','t_ref_count','n_alt_count','n_depth','n_ref_count','tau','f_acs','Chromosome','genomic_coord_x'])
     else:
         indel_table['t_depth'] = t_alt_count + t_ref_count
@@ -624,31 +1036,25 @@ def read_indel_vcf(vcf,seg_table,indel_type):
         indel_table['n_ref_count'] = n_ref_count
     # only consider sites which were rejected as germline or were passed
         if type(indel_table['contig'][0]) == str :
-            indel_table['Chromosome'] = chr2num(indel_table['contig'])
+            indel_table['Chromosome'] = chr2num(indel_table['contig'], genome)
         else:
             indel_table['Chromosome'] = indel_table['contig']-1
     # add linear position field and consider only sites which are rejected as germline i.e. PASS or QSI_ref
         indel_table = indel_table[np.isfinite(indel_table['Chromosome'])]
         indel_table.reset_index(inplace=True, drop=True)
-        indel_table['genomic_coord_x'] = hg19_to_linear_positions(indel_table['Chromosome'], indel_table['position'])
+        indel_table['genomic_coord_x'] = genome.linear_positions(indel_table['Chromosome'], indel_table['position'])
     # annotate with acs data
-        f_acs = np.zeros([len(indel_table), 1]) + 0.5
-        tau = np.zeros([len(indel_table), 1]) + 2
-        for i, r in seg_table.iterrows():
-            f_acs[np.logical_and(np.array(indel_table['genomic_coord_x']) >= r['genomic_coord_start'],
-                             np.array(indel_table['genomic_coord_x']) <= r['genomic_coord_end'])] = r.f
-            tau[np.logical_and(np.array(indel_table['genomic_coord_x']) >= r['genomic_coord_start'],
-                           np.array(indel_table['genomic_coord_x']) <= r[
-                               'genomic_coord_end'])] = r.tau + 0.001
-        indel_table['tau'] = tau
-        indel_table['f_acs'] = f_acs
+        segments = segment_index(seg_table)
+        seg_rows = segments.lookup(indel_table['genomic_coord_x'])
+        indel_table['tau'] = np.where(seg_rows >= 0, segments.values(seg_rows, 'tau', 2) + 0.001, 2)
+        indel_table['f_acs'] = segments.values(seg_rows, 'f', 0.5)
     return indel_table
 
 def build_exac_pickle(exac_file):
     # create ExAC site dictionary from VCF file
     exac_site_info = {}
     print('Filtering ExAC sites from candidate mutations')
-    with gzip.open(exac_file, "rb") as vcf_file:
+    with gzip.open(exac_file, "rt") as vcf_file:
         for line_index, line in enumerate(vcf_file):
             if line_index % 10000 == 0:
                 print('processed ' + str(line_index) + ' ExAC sites')
@@ -676,18 +1082,295 @@ def build_exac_pickle(exac_file):
         pickle.dump(exac_site_info, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-def remove_exac_sites_from_call_stats(call_stats_table, exac_file):
-    # use ExAC vcf to filter likely germline variants out of candidate sites
+# germline site index: sorted unique site keys, stored as .npy and memory mapped on load
+germline_site_dtype = np.dtype(np.int64)
+
+
+def germline_site_keys(contigs, positions):
+    # int64 key of each site: (chromosome code + 32 for chr prefixed contig names) * 2 ** 32 + position
+    # contigs with and without chr prefix get different keys so that an index of one naming convention
+    # (and reference build) never matches sites of the other. Sites of contigs outside 1-22, X, Y, M are
+    # dropped, known marks the sites which have a key
+    contigs = np.array(contigs, dtype=str)
+    chromosome = genome_index().chromosome_codes(contigs) + 32 * np.char.startswith(contigs, 'chr')
+    known = np.isfinite(chromosome)
+    keys = np.array(chromosome[known]).astype(np.int64) * 2 ** 32 + np.array(positions)[known].astype(np.int64)
+    return keys, known
+
+
+def germline_site_prefixed(keys):
+    # whether each germline site key was made from a chr prefixed contig name
+    return np.right_shift(np.asarray(keys), 32) >= 32
+
+
+def germline_site_index(contigs, positions):
+    # sorted germline site index of the sites on chromosomes 1-22, X, Y, M
+    # sites are matched by contig name and position (as the ExAC site dictionary was), alleles are not stored
+    keys, _ = germline_site_keys(contigs, positions)
+    return np.unique(keys).astype(germline_site_dtype)
+
+
+def build_germline_site_index(vcf_file, output_file, min_af=0.01, threads=1, chunk_size=64):
+    # germline site index of the sites of a population VCF (e.g. ExAC, gnomAD) whose allele fractions sum
+    # to at least min_af, written to output_file (.npy)
+    # bgzipped VCFs are cut into chunks of ~chunk_size MB of BGZF blocks which are decompressed and parsed
+    # by threads worker processes, other VCFs are streamed line by line
+    chunks = bgzf_chunks(vcf_file, chunk_size * 1024 ** 2) if vcf_file[-2:] == 'gz' else None
+    if chunks is None:
+        index = germline_sites_in_stream(vcf_file, min_af)
+    else:
+        print('parsing ' + str(len(chunks)) + ' BGZF chunks of ' + vcf_file)
+        arguments = [[vcf_file] * len(chunks), chunks, [i == 0 for i in range(len(chunks))], [min_af] * len(chunks)]
+        if threads > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=min(threads, len(chunks))) as pool:
+                chunk_indexes = list(pool.map(germline_sites_in_chunk, *arguments))
+        else:
+            chunk_indexes = list(map(germline_sites_in_chunk, *arguments))
+        index = np.unique(np.concatenate(chunk_indexes))
+    print('writing ' + str(len(index)) + ' germline sites to ' + output_file)
+    np.save(output_file, index)
+
+
+def germline_sites_in_stream(vcf_file, min_af):
+    contigs, positions = [], []
+    with (gzip.open(vcf_file, 'rt') if vcf_file[-2:] == 'gz' else open(vcf_file)) as vcf:
+        for line_index, line in enumerate(vcf):
+            if line_index % 1000000 == 0:
+                print('processed ' + str(line_index) + ' germline sites')
+            if line[0] == '#':
+                continue
+            spl = line.rstrip('\n').split('\t', 8)
+            af = [field[3:] for field in spl[7].split(';') if field[0:3] == 'AF=']
+            if len(af) == 0 or np.sum(np.array(af[0].split(','), dtype=float)) < min_af:
+                continue
+            contigs.append(spl[0])
+            positions.append(int(spl[1]))
+    return germline_site_index(contigs, positions)
+
+
+def bgzf_chunks(gz_file, chunk_bytes):
+    # (start, end) file offsets of runs of whole BGZF blocks of about chunk_bytes compressed bytes
+    # None if the file is not BGZF (plain gzip)
+    block_starts = []
+    size = os.path.getsize(gz_file)
+    with open(gz_file, 'rb') as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            header = f.read(18)
+            # gzip member with FEXTRA whose first subfield is BC (block size - 1)
+            if len(header) < 18 or header[0:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+                return None
+            block_starts.append(offset)
+            offset += struct.unpack('<H', header[16:18])[0] + 1
+    block_starts = np.array(block_starts + [size])
+    bounds = np.unique(np.append(block_starts[np.searchsorted(block_starts, np.arange(0, size, chunk_bytes))], size))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def bgzf_decompress(data):
+    # decompressed bytes of a run of gzip members
+    decompressed = []
+    while len(data) > 0:
+        member = zlib.decompressobj(31)
+        decompressed.append(member.decompress(data))
+        data = member.unused_data
+    return b''.join(decompressed)
+
+
+def germline_sites_in_chunk(vcf_file, chunk, first_chunk, min_af):
+    # germline site index of the VCF lines starting in the BGZF blocks chunk = (start, end)
+    # every chunk reads on to the first line end after the chunk and all but the first chunk skip
+    # everything up to their first line end, so each line is parsed by exactly one chunk
+    # (chunks are assumed to hold at least one line end)
+    start, end = chunk
+    with open(vcf_file, 'rb') as f:
+        f.seek(start)
+        data = bgzf_decompress(f.read(end - start))
+        tail = b''
+        while b'\n' not in tail:
+            header = f.read(18)
+            if len(header) < 18:
+                break
+            tail += bgzf_decompress(header + f.read(struct.unpack('<H', header[16:18])[0] + 1 - 18))
+    if not first_chunk:
+        data = data[data.find(b'\n') + 1:] if b'\n' in data else b''
+    data += tail[0:tail.find(b'\n') + 1] if b'\n' in tail else tail
+    # header lines are at the start of the first chunk
+    while data[0:1] == b'#':
+        data = data[data.find(b'\n') + 1:] if b'\n' in data else b''
+    if len(data) == 0:
+        return np.zeros(0, dtype=germline_site_dtype)
+    # only CHROM, POS and INFO are parsed, sites are indexed by position
+    sites = pd.read_csv(io.BytesIO(data), sep='\t', header=None, usecols=[0, 1, 7], dtype={0: str, 7: str},
+                        quoting=3, low_memory=False)
+    af = sites[7].str.extract(r'(?:^|;)AF=([^;]*)', expand=False)
+    af = af.str.split(',', expand=True).apply(pd.to_numeric, errors='coerce').sum(axis=1, min_count=1)
+    sites = sites[np.array(af >= min_af)]
+    return germline_site_index(sites[0], sites[1])
+
+
+def convert_exac_pickle(exac_file, output_file):
+    # germline site index (.npy) of an ExAC pickle made by build_exac_pickle
+    with open(exac_file, 'rb') as handle:
+        np.save(output_file, exac_pickle_site_index(pickle.load(handle)))
+
+
+def exac_pickle_site_index(exac_dict):
+    keys = [key.rsplit('_', 1) for key in exac_dict]
+    return germline_site_index([key[0] for key in keys], [int(key[1]) for key in keys])
+
+
+def load_germline_site_index(exac_file, cache_dir=None):
+    # .npy germline site indexes are memory mapped (read only pages shared by concurrent runs)
+    # any other file is read as a legacy ExAC pickle, converted once to a .npy index in cache_dir (next to the
+    # pickle without cache_dir) whose name holds the size and modification time of the pickle
+    if exac_file[-4:] == '.npy':
+        return np.load(exac_file, mmap_mode='r')
+    source = os.stat(exac_file)
+    cache_file = cache_file_path(exac_file, cache_dir, '.' + str(source.st_size) + '.' + str(int(source.st_mtime)) +
+                                 '.npy')
+    if os.path.exists(cache_file):
+        try:
+            return np.load(cache_file, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            pass
+    print('converting legacy ExAC pickle ' + exac_file + ' to a germline site index')
     with open(exac_file, 'rb') as handle:
-        exac_dict = pickle.load(handle)
-        keep = np.ones_like(call_stats_table['position'], dtype=bool)
-    for index, row in call_stats_table.iterrows():
-        key = str(row['contig']) + '_' + str(row['position'])
-        if row['judgement'] == 'REJECT':
-            try:
-                exac_dict[key]
-                # print 'removing site '+ key+ ' minor allele fraction = ' + str(exac_dict[key]['AF'])
-                keep[index] = False
-            except KeyError:
-                pass
+        index = exac_pickle_site_index(pickle.load(handle))
+    if not write_cache(cache_file, lambda handle: np.save(handle, index)):
+        print('could not write germline site index ' + cache_file + ', pass a .npy index to skip this conversion')
+    return index
+
+
+def kmeans_1d(values, k):
+    # optimal (minimum within-cluster sum of squares) k-means of 1-D data by dynamic programming over the
+    # sorted values, deterministic drop-in for scipy.cluster.vq.kmeans on a vector
+    # returns the sorted centroids and the mean distance of the values to their closest centroid
+    # as scipy does. Fewer than k centroids are returned when there are fewer than k distinct values
+    values = np.sort(np.asarray(values, dtype=float))
+    n = len(values)
+    k = min(k, len(np.unique(values)))
+    s1 = np.concatenate([[0], np.cumsum(values)])
+    s2 = np.concatenate([[0], np.cumsum(np.power(values, 2))])
+    # cost[j, i] = sum of squares of values[j:i] around their mean
+    j, i = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing='ij')
+    size = np.maximum(i - j, 1)
+    cost = s2[i] - s2[j] - np.true_divide(np.power(s1[i] - s1[j], 2), size)
+    cost[i <= j] = np.inf
+    # best[m, i] = minimum cost of the first i sorted values in m + 1 clusters
+    best = np.zeros([k, n + 1]) + np.inf
+    split = np.zeros([k, n + 1], dtype=int)
+    best[0, :] = cost[0, :]
+    for m in range(1, k):
+        total = best[m - 1, :, np.newaxis] + cost
+        split[m, :] = np.argmin(total, axis=0)
+        best[m, :] = total[split[m, :], np.arange(n + 1)]
+    bounds = [n]
+    for m in range(k - 1, 0, -1):
+        bounds.append(split[m, bounds[-1]])
+    bounds.append(0)
+    bounds = bounds[::-1]
+    centroids = np.array([np.mean(values[bounds[c]:bounds[c + 1]]) for c in range(k)])
+    distortion = np.mean(np.min(np.abs(values[:, np.newaxis] - centroids), axis=1))
+    return centroids, distortion
+
+
+def build_hot_spot_index(hot_spots_file, genome=None):
+    # parse a cancer hot spot file (Chromosome, Position, Probability) into arrays sorted by linear coordinate
+    # a position listed more than once takes the probability of its last row
+    if genome is None:
+        genome = genome_index()
+    hot_spots = pd.read_csv(hot_spots_file, sep='\t', low_memory=False, index_col=False)
+    if type(hot_spots['Chromosome'][0]) == str:
+        contig = chr2num(np.array(hot_spots['Chromosome']), genome)
+    else:
+        contig = np.array(hot_spots['Chromosome']) - 1
+    hot_spots = hot_spots[np.isfinite(contig)]
+    contig = contig[np.isfinite(contig)]
+    genomic_coord_x = genome.linear_positions(contig, np.array(hot_spots['Position']))
+    order = np.argsort(genomic_coord_x, kind='mergesort')
+    genomic_coord_x = genomic_coord_x[order]
+    last = np.append(genomic_coord_x[1:] != genomic_coord_x[:-1], True)
+    order = order[last]
+    return {'genomic_coord_x': genomic_coord_x[last],
+            'Chromosome': np.array(hot_spots['Chromosome'], dtype=str)[order],
+            'Position': np.array(hot_spots['Position'], dtype=int)[order],
+            'Probability': np.array(hot_spots['Probability'], dtype=float)[order]}
+
+
+def load_hot_spot_index(hot_spots_file, genome=None, cache_dir=None):
+    # hot spot index cached as <hot_spots_file name>.npz in cache_dir (next to the hot spot file without cache_dir)
+    # the cache is rebuilt when the size or modification time of the hot spot file or the chromosome
+    # lengths of the genome change
+    if genome is None:
+        genome = genome_index()
+    cache_file = cache_file_path(hot_spots_file, cache_dir, '.npz')
+    source = os.stat(hot_spots_file)
+    if os.path.exists(cache_file):
+        try:
+            cache = np.load(cache_file)
+            if cache['source_size'] == source.st_size and cache['source_mtime'] == source.st_mtime and \
+                    np.array_equal(cache['genome_lengths'], genome.lengths):
+                return dict((key, cache[key]) for key in ['genomic_coord_x', 'Chromosome', 'Position', 'Probability'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    hot_spots = build_hot_spot_index(hot_spots_file, genome)
+    if not write_cache(cache_file, lambda handle: np.savez(handle, source_size=source.st_size,
+                                                           source_mtime=source.st_mtime,
+                                                           genome_lengths=genome.lengths, **hot_spots)):
+        print('could not write hot spot cache ' + cache_file)
+    return hot_spots
+
+
+def cache_file_path(source_file, cache_dir, suffix):
+    # <cache_dir>/<source file name><suffix>, <source_file><suffix> without cache_dir
+    if cache_dir is None or cache_dir == 'None':
+        return source_file + suffix
+    return os.path.join(cache_dir, os.path.basename(source_file) + suffix)
+
+
+def write_cache(cache_file, save):
+    # save(handle) writes the cache to a temporary file which is then renamed, so that concurrent runs never
+    # read a partial cache. The temporary file is removed if writing fails. returns whether the cache was written
+    tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+    try:
+        if os.path.dirname(cache_file) != '' and not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        try:
+            with open(tmp_file, 'wb') as handle:
+                save(handle)
+            os.rename(tmp_file, cache_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def sorted_lookup(sorted_keys, keys):
+    # index of each key in the sorted array of unique keys sorted_keys, -1 for keys which are not present
+    keys = np.asarray(keys)
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=int) - 1
+    idx = np.searchsorted(sorted_keys, keys)
+    idx[idx == len(sorted_keys)] = 0
+    return np.where(sorted_keys[idx] == keys, idx, -1)
+
+
+def remove_exac_sites_from_call_stats(call_stats_table, exac_file, cache_dir=None):
+    # use the germline site index (or a legacy ExAC pickle) to filter likely germline variants out of
+    # rejected candidate sites with one sorted membership test
+    germline_sites = load_germline_site_index(exac_file, cache_dir)
+    sites, known = germline_site_keys(call_stats_table['contig'], call_stats_table['position'])
+    if len(germline_sites) > 0 and len(sites) > 0:
+        # an index whose contig names all differ in chr prefix from the call stats cannot match any site
+        index_prefixed = np.unique(germline_site_prefixed(germline_sites[[0, -1]]))
+        if not np.any(np.isin(germline_site_prefixed(sites), index_prefixed)):
+            sys.exit('the contig names of the germline site index ' + exac_file + ' and the call stats differ in '
+                     'chr prefix, use a germline site index of the reference build of the call stats')
+    is_germline = np.zeros(len(call_stats_table), dtype=bool)
+    is_germline[known] = sorted_lookup(germline_sites, sites) >= 0
+    keep = ~np.logical_and(is_germline, np.array(call_stats_table['judgement'] == 'REJECT'))
     return call_stats_table[keep]
@@ -57,6 +57,10 @@ params.exac_data_path = ""
 params.indel_data_path = ""
 params.indel_data_type = "MuTect2"
 params.output_name = ""
+params.genome_build = "GRCh38"  // hg19 or GRCh38, build of the input coordinates
+params.max_memory = ""  // GB for the likelihood kernel temporaries, defaults to half of params.mem
+params.cache_dir = ""  // shared directory for the hot spot and ExAC pickle caches, defaults to the task directory
+params.plots = "all"
 params.output_pattern = "*.TiN_estimate.txt"  // output file name pattern
 
 
@@ -85,7 +89,7 @@ process detin {
     """
     mkdir -p outdir
 
-    python /tools/deTiN/deTiN.py --mutation_data_path ${mutation_data_path} --cn_data_path ${cn_data_path} --tumor_het_data ${tumor_het_data} --normal_het_data ${normal_het_data} --exac_data_path ${exac_data_path} --output_name ${output_name} --indel_data_path ${indel_data_path} --indel_data_type ${indel_data_type} --output_dir outdir
+    python /tools/deTiN/deTiN.py --mutation_data_path ${mutation_data_path} --cn_data_path ${cn_data_path} --tumor_het_data ${tumor_het_data} --normal_het_data ${normal_het_data} --exac_data_path ${exac_data_path} --output_name ${output_name} --indel_data_path ${indel_data_path} --indel_data_type ${indel_data_type} --output_dir outdir --max_memory ${params.max_memory ?: params.mem / 2} --threads ${params.cpus} --genome_build ${params.genome_build} --plots ${params.plots} --cache_dir ${params.cache_dir ?: '.'}
     """
 }
 
@@ -0,0 +1,120 @@
+# unit tests of the deTiN helpers, run with python -m pytest from the detin directory
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'deTiN'))
+import deTiN_aSCNA_based_estimate as dascna
+import deTiN_utilities as du
+
+INPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input')
+
+
+def ascna_model(het_segs, n_segs):
+    # aSCNA model with n_segs segments and one het per entry of het_segs (segment id of the het)
+    segs = pd.DataFrame({'Chromosome': np.zeros(n_segs)}, index=np.arange(n_segs))
+    hets = pd.DataFrame({'seg_id': het_segs, 'tau': np.full(len(het_segs), 2.0), 'AF_N': np.full(len(het_segs), 0.5)})
+    return dascna.model(segs, hets, resolution=11)
+
+
+def test_segment_sums_with_empty_segments():
+    # segments 1 and 4 have no hets, hets are not ordered by segment
+    het_segs = [3, 0, 2, 0, 3, 2, 2, 0]
+    model = ascna_model(het_segs, 5)
+    values = np.arange(1, len(het_segs) + 1, dtype=float)
+    expected = np.array([np.sum(values[np.array(het_segs) == seg]) for seg in range(5)])
+    assert np.array_equal(model.segment_sums(values), expected)
+    matrix = np.column_stack([values, 10 * values])
+    assert np.array_equal(model.segment_sums(matrix), np.column_stack([expected, 10 * expected]))
+
+
+def test_segment_sums_with_empty_last_segment():
+    het_segs = np.repeat([0, 1], 5)
+    model = ascna_model(het_segs, 3)
+    assert np.array_equal(model.segment_sums(np.arange(10, dtype=float)), [10, 35, 0])
+
+
+def test_segment_variances_match_nanvar():
+    het_segs = np.array([1, 1, 1, 3, 3, 0, 0, 0, 0])
+    model = ascna_model(het_segs, 4)
+    values = np.array([1, 4, np.nan, 2, 8, 5, 5, 7, 1], dtype=float)
+    variances = model.segment_variances(values)
+    for seg in [0, 1, 3]:
+        assert np.isclose(variances[seg], np.nanvar(values[het_segs == seg]))
+    assert np.isnan(variances[2])
+
+
+def test_read_sanger_indel_vcf():
+    # Sanger (pindel) VCFs name their samples NORMAL and TUMOUR, the samples are read by column position
+    genome = du.genome_index('hg19')
+    seg_table = pd.DataFrame({'genomic_coord_start': genome.linear_positions([0], [1]),
+                              'genomic_coord_end': genome.linear_positions([0], [5000000]),
+                              'tau': [3.0], 'f': [0.4]})
+    indels = du.read_indel_vcf(os.path.join(INPUT_DIR, 'sanger.indels.vcf'), seg_table, 'Sanger', genome)
+    # the F004 record is not a candidate
+    assert list(indels['position']) == [1000000, 7000000]
+    assert list(indels['n_alt_count']) == [1, 3]
+    assert list(indels['n_ref_count']) == [29, 19]
+    assert list(indels['t_alt_count']) == [15, 11]
+    assert list(indels['t_ref_count']) == [27, 19]
+    # only the first indel is inside the segment
+    assert np.allclose(indels['tau'], [3.001, 2])
+    assert np.allclose(indels['f_acs'], [0.4, 0.5])
+
+
+def test_germline_sites_match_contig_prefix(tmp_path):
+    index_file = str(tmp_path / 'sites.npy')
+    np.save(index_file, du.germline_site_index(['1', '2', 'GL000192.1'], [100, 7, 5]))
+    call_stats = pd.DataFrame({'contig': ['1', '1', '2'], 'position': [100, 101, 7], 'judgement': ['REJECT'] * 3})
+    assert list(du.remove_exac_sites_from_call_stats(call_stats, index_file)['position']) == [101]
+    # the same positions on chr prefixed contigs are a different naming convention (build) and are rejected
+    call_stats['contig'] = ['chr1', 'chr1', 'chr2']
+    with pytest.raises(SystemExit):
+        du.remove_exac_sites_from_call_stats(call_stats, index_file)
+
+
+def test_write_cache_removes_temporary_file_on_failure(tmp_path):
+    def failing_save(handle):
+        handle.write(b'partial')
+        raise IOError('disk full')
+    cache_file = str(tmp_path / 'hot_spots.npz')
+    assert not du.write_cache(cache_file, failing_save)
+    assert os.listdir(str(tmp_path)) == []
+    assert du.write_cache(str(tmp_path / 'cache' / 'hot_spots.npz'), lambda handle: np.savez(handle, x=np.arange(3)))
+    assert os.listdir(str(tmp_path / 'cache')) == ['hot_spots.npz']
+
+
+def test_hot_spot_index_is_cached_in_cache_dir(tmp_path):
+    hot_spots_file = str(tmp_path / 'hot_spots.tsv')
+    pd.DataFrame({'Chromosome': ['1', '2', '1'], 'Position': [300, 5, 100],
+                  'Probability': [0.1, 0.2, 0.3]}).to_csv(hot_spots_file, sep='\t', index=False)
+    cache_dir = str(tmp_path / 'cache')
+    hot_spots = du.load_hot_spot_index(hot_spots_file, du.genome_index('hg19'), cache_dir)
+    assert list(hot_spots['Position']) == [100, 300, 5]
+    assert os.listdir(cache_dir) == ['hot_spots.tsv.npz']
+    cached = du.load_hot_spot_index(hot_spots_file, du.genome_index('hg19'), cache_dir)
+    assert np.array_equal(cached['genomic_coord_x'], hot_spots['genomic_coord_x'])
+
+
+def add_one_task(block, inputs, outputs):
+    start, stop = block
+    outputs['y'][:, start:stop] = inputs['x'][:, start:stop] + 1
+
+
+def test_executor_reuses_its_pool():
+    import deTiN_parallel as dpar
+    executor = dpar.executor('thread', 3)
+    x = np.arange(20, dtype=float).reshape(2, 10)
+    for _ in range(2):
+        outputs = {'y': np.zeros(x.shape)}
+        executor.run(add_one_task, dpar.column_blocks(10, 3), {'x': x}, outputs)
+        assert np.array_equal(outputs['y'], x + 1)
+    pool = executor.pool
+    executor.run(add_one_task, dpar.column_blocks(10, 3), {'x': x}, {'y': np.zeros(x.shape)})
+    assert executor.pool is pool
+    assert dpar.as_executor(executor) is executor
+    executor.shutdown()
+    assert executor.pool is None